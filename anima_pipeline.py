@@ -0,0 +1,286 @@
+import os
+import sys
+import csv
+import json
+import time
+import shutil
+import hashlib
+import functools
+import contextlib
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+#
+# Execution of the stages of the Anima preprocessing scripts
+# (modifiedAnimaDiffusionImagePreprocessing_Sebastien_flip.py) with checkpointing.
+#
+# A stage is an external command (or a python function) with the files it reads and the files it writes.
+# Completed stages are recorded in a checkpoint file (<dwi prefix>_stages.json) with a fingerprint of
+# their command and of the name, size and mtime of their inputs. When the script is run again, a stage
+# whose fingerprint did not change and whose outputs exist is skipped: a crash of a late stage does not
+# mean running the whole chain again. A stage which is run again writes new outputs, so the stages
+# reading them are run again too.
+#
+# A stage which fails (non-zero return code, exception or missing output) stops the chain, the
+# checkpoint keeps the stages completed before it.
+#
+# The stages are declared first (add_stage) and then run by run_stages as a graph: a stage depends
+# on the stages writing its inputs, and on the stages reading or writing its outputs before it in the
+# order of declaration. The stages whose dependencies are done run concurrently within a budget
+# of CPUs, shared between them through ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS (used by the Anima tools).
+#
+# The intermediate images can be written to a scratch folder (e.g. on a node-local disk), removed at the
+# end if it was created by scratch_folder. It is kept when a stage fails: the stages reading a removed
+# intermediate image would run again the stages writing it, up to the first one.
+# Only the inputs which are not written by a stage are part of the fingerprints, the changes of the others
+# are followed through the stages writing them: a stage is run again when a stage writing one of its inputs
+# is run, and a stage writing a removed input of a stage to run is run again. The outputs in the scratch
+# folder do not need to exist for a stage to be up to date.
+#
+# Each stage run records its wall time, and for commands the CPU time and peak resident memory of the
+# process (from os.wait4), with the size of its outputs. The values of all the stages are written to a
+# report (<dwi prefix>_timings.json and .csv), aggregated over subjects by preprocess_cohort.py.
+#
+
+# extensions of the intermediate images of the tmp folder: .nii images are written uncompressed, so that each
+# stage reads the image of the previous one without decompressing it (and can map it in memory), only the
+# final outputs (.nii.gz) are compressed; .nrrd is the format of the previous versions of the scripts
+INTERMEDIATE_EXTENSIONS = { 'nii': '.nii', 'nrrd': '.nrrd' }
+
+def file_state(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+def command_text(command):
+    if isinstance(command, functools.partial):
+        return command_text(command.func) + '\0' + '\0'.join(str(arg) for arg in command.args)
+    if callable(command):
+        return command.__module__ + '.' + command.__qualname__
+    return '\0'.join(command)
+
+def stage_fingerprint(command, inputs, outputs):
+    sha1 = hashlib.sha1(command_text(command).encode())
+    for path in inputs:
+        sha1.update(json.dumps([path, file_state(path)]).encode())
+    sha1.update('\0'.join(outputs).encode())
+    return sha1.hexdigest()
+
+def load_checkpoint(path, force=False):
+    stages = {}
+    if not force and os.path.exists(path):
+        with open(path) as file:
+            stages = json.load(file)
+    return { 'path': path, 'stages': stages, 'lock': threading.Lock() }
+
+# update the record of the stage (removed if None) and save the checkpoint, stages run concurrently
+def save_checkpoint(checkpoint, name, record):
+    path = checkpoint['path']
+    with checkpoint['lock']:
+        if record is None:
+            checkpoint['stages'].pop(name, None)
+        else:
+            checkpoint['stages'][name] = record
+        with open(path + '.tmp', 'w') as file:
+            json.dump(checkpoint['stages'], file, indent=1, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+def in_folder(path, folder):
+    return folder is not None and os.path.abspath(path).startswith(os.path.abspath(folder) + os.sep)
+
+def is_up_to_date(checkpoint, stage, fingerprint, scratch=None):
+    record = checkpoint['stages'].get(stage['name'])
+    return record is not None and record['fingerprint'] == fingerprint and \
+        all(os.path.exists(path) for path in stage['outputs'] if not in_folder(path, scratch))
+
+# write the text to the file only if it differs from its content, so that the stages reading it are not run again
+def write_if_changed(path, text):
+    if os.path.exists(path):
+        with open(path) as file:
+            if file.read() == text:
+                return False
+    with open(path, 'w') as file:
+        file.write(text)
+    return True
+
+# threads is the maximum number of threads of the stage, None for the whole CPU budget
+def add_stage(stages, name, command, inputs=(), outputs=(), threads=None):
+    if any(stage['name'] == name for stage in stages):
+        raise ValueError('Stage ' + name + ' is declared twice')
+    stages.append({ 'name': name, 'command': command, 'inputs': list(inputs), 'outputs': list(outputs), 'threads': threads })
+
+# names of the stages each stage has to wait for, and stage writing each of its inputs written by a stage
+def stage_dependencies(stages):
+    writers = {}
+    readers = {}
+    dependencies = {}
+    producers = {}
+    for stage in stages:
+        producers[stage['name']] = { path: writers[path] for path in stage['inputs'] if path in writers }
+        depends = set(producers[stage['name']].values())
+        for path in stage['outputs']:
+            if path in writers:
+                depends.add(writers[path])
+            depends.update(readers.pop(path, set()))
+        depends.discard(stage['name'])
+        dependencies[stage['name']] = depends
+        for path in stage['inputs']:
+            readers.setdefault(path, set()).add(stage['name'])
+        for path in stage['outputs']:
+            writers[path] = stage['name']
+    return dependencies, producers
+
+# fingerprint of each stage, and names of the stages to run: the ones which are not up to date, the ones
+# reading an output of a stage to run and the ones writing a missing input of a stage to run
+def stages_to_run(checkpoint, stages, producers, scratch=None):
+    fingerprints = {}
+    toRun = set()
+    for stage in stages:
+        externalInputs = [path for path in stage['inputs'] if path not in producers[stage['name']]]
+        fingerprints[stage['name']] = stage_fingerprint(stage['command'], externalInputs, stage['outputs'])
+        if not is_up_to_date(checkpoint, stage, fingerprints[stage['name']], scratch):
+            toRun.add(stage['name'])
+
+    changed = True
+    while changed:
+        changed = False
+        for stage in stages:
+            name = stage['name']
+            if name not in toRun and any(producer in toRun for producer in producers[name].values()):
+                toRun.add(name)
+                changed = True
+            if name in toRun:
+                for path, producer in producers[name].items():
+                    if producer not in toRun and not os.path.exists(path):
+                        toRun.add(producer)
+                        changed = True
+    return fingerprints, toRun
+
+# run the command, returns the CPU time (user and system) and the peak resident memory of its process
+# (including the processes it waited for, e.g. the Anima tools of a python script)
+def run_command(command, env=None):
+    process = subprocess.Popen(command, env=env)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    maxRss = usage.ru_maxrss / 2**20 if sys.platform == 'darwin' else usage.ru_maxrss / 2**10
+    return { 'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 3), 'max_rss_mb': round(maxRss, 1) }
+
+# run the command of the stage and record it in the checkpoint with its fingerprint and its resource usage
+def run_stage(checkpoint, stage, fingerprint, threads=None):
+    name, command, outputs = stage['name'], stage['command'], stage['outputs']
+    record = { 'fingerprint': fingerprint, 'threads': threads }
+
+    # the previous record is not valid anymore, even if the command fails
+    if name in checkpoint['stages']:
+        save_checkpoint(checkpoint, name, None)
+
+    print('Stage', name, 'started' + ('' if threads is None else ' with ' + str(threads) + ' threads'))
+    start = time.perf_counter()
+    try:
+        if callable(command):
+            command()
+        else:
+            env = None if threads is None else dict(os.environ, ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS=str(threads))
+            record.update(run_command(command, env))
+        missing = [path for path in outputs if not os.path.exists(path)]
+        if len(missing) > 0:
+            raise RuntimeError('Stage ' + name + ' did not write ' + ', '.join(missing))
+    except Exception:
+        print('Stage', name, 'failed, no other stage is started')
+        raise
+
+    record['seconds'] = round(time.perf_counter() - start, 3)
+    record['output_bytes'] = sum(os.path.getsize(path) for path in outputs)
+    save_checkpoint(checkpoint, name, record)
+
+REPORT_COLUMNS = ['stage', 'status', 'seconds', 'cpu_seconds', 'max_rss_mb', 'output_bytes', 'threads']
+
+# status (run, skipped, failed or not run) of each stage and the values recorded when it was last run,
+# in <prefix>.json and <prefix>.csv
+def write_report(prefix, checkpoint, stages, statuses):
+    report = {}
+    for stage in stages:
+        record = checkpoint['stages'].get(stage['name'], {})
+        report[stage['name']] = dict({ key: record[key] for key in REPORT_COLUMNS[2:] if key in record }, status=statuses[stage['name']])
+    with open(prefix + '.json', 'w') as file:
+        json.dump(report, file, indent=1)
+    with open(prefix + '.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(REPORT_COLUMNS)
+        for name, values in report.items():
+            writer.writerow([name] + [values.get(key, '') for key in REPORT_COLUMNS[1:]])
+
+# run the stages in an order compatible with their dependencies, the ready ones concurrently: the CPUs
+# of the budget not used by the running stages are shared between the ready stages.
+# After a failure no stage is started, the running ones are waited for and the error is raised.
+# The report is written to <report>.json and .csv if report is given, also after a failure.
+def run_stages(checkpoint, stages, cpu_budget=None, scratch=None, report=None):
+    cpu_budget = cpu_budget or os.cpu_count()
+    dependencies, producers = stage_dependencies(stages)
+    fingerprints, toRun = stages_to_run(checkpoint, stages, producers, scratch)
+    for stage in stages:
+        if stage['name'] not in toRun:
+            print('Stage', stage['name'], 'is up to date, skipped')
+    remaining = [stage for stage in stages if stage['name'] in toRun]
+    done = set(stage['name'] for stage in stages if stage['name'] not in toRun)
+    statuses = { stage['name']: 'run' if stage['name'] in toRun else 'skipped' for stage in stages }
+    running = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=max(1, len(stages))) as executor:
+        while len(remaining) > 0 or len(running) > 0:
+            ready = [stage for stage in remaining if dependencies[stage['name']] <= done] if error is None else []
+            for i, stage in enumerate(ready):
+                available = cpu_budget - sum(threads for _, threads in running.values())
+                if available < 1 and len(running) > 0:
+                    break
+                threads = min(stage['threads'] or cpu_budget, max(1, available // (len(ready) - i)))
+                running[executor.submit(run_stage, checkpoint, stage, fingerprints[stage['name']], threads)] = (stage, threads)
+                remaining.remove(stage)
+            if len(running) == 0:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage, _ = running.pop(future)
+                try:
+                    future.result()
+                    done.add(stage['name'])
+                except Exception as e:
+                    statuses[stage['name']] = 'failed'
+                    error = error or e
+    for stage in remaining:
+        statuses[stage['name']] = 'not run'
+    if report is not None:
+        write_report(report, checkpoint, stages, statuses)
+    if error is not None:
+        raise error
+
+# file marking the folders created by scratch_folder
+SCRATCH_MARKER = '.anima_pipeline_scratch'
+
+# folder of the intermediate images, removed when the stages are done; when they failed it is kept (to look at
+# the images and to run the stages again from where they stopped), unless removeOnFailure.
+# Only a folder created by scratch_folder (in this run, or in a previous one which kept it) is removed,
+# an existing folder without the marker is used as is and kept
+@contextlib.contextmanager
+def scratch_folder(path, removeOnFailure=False):
+    marker = os.path.join(path, SCRATCH_MARKER)
+    if not os.path.exists(path):
+        os.makedirs(path)
+        open(marker, 'w').close()
+    created = os.path.exists(marker)
+    try:
+        yield path
+    except BaseException:
+        if created and removeOnFailure:
+            shutil.rmtree(path, ignore_errors=True)
+        elif created:
+            print('Scratch folder kept in', path)
+        raise
+    if created:
+        shutil.rmtree(path, ignore_errors=True)
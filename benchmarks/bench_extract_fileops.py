@@ -0,0 +1,73 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import extract_nifti_from_dicom
+
+#
+# Benchmark of the post-conversion stage of extract_nifti_from_dicom.py (rename, move and cleanup
+# of the dcm2niix outputs), per subject: the previous shell commands (mv with globs, find -exec rm)
+# against the in-process file operations (organize_outputs and remove_non_dicom).
+# Synthetic subjects are created in a temporary data folder, with the DICOM files, the dcm2niix
+# outputs and the other files of a Shanoir archive.
+#
+# python benchmarks/bench_extract_fileops.py -n 20 --dicom 31 --other 40
+#
+
+def create_subject(dataFolder, filename, bidsDir, nbDicom, nbOther):
+    pathToDicom = os.path.join(dataFolder, filename, bidsDir, 'dicom')
+    os.makedirs(os.path.join(pathToDicom, 'series'))
+    for i in range(nbDicom):
+        Path(pathToDicom, 'series', str(i) + '.dcm').write_bytes(b'\0' * 4096)
+    for i in range(nbOther):
+        Path(pathToDicom, 'series', str(i) + '.txt').write_bytes(b'\0' * 128)
+    for extension in ['.nii.gz', '.bval', '.bvec', '.json']:
+        Path(pathToDicom, 'series_dwi' + extension).write_bytes(b'\0' * 4096)
+
+# the commands of the previous version of the script, with the data folder instead of ~/Projects/longidep/scripts/
+def shell_fileops(dataFolder, filename, bidsDir):
+    pathToDicom = dataFolder + '/' + filename + '/' + bidsDir + '/' + 'dicom'
+    subprocess.run(["mv " + pathToDicom + '/*.bval ' + pathToDicom + '/encoding_' + filename + '.bval'], shell=True)
+    subprocess.run(["mv " + pathToDicom + '/*.nii.gz ' + pathToDicom + '/dwi_' + filename + '.nii.gz'], shell=True)
+    subprocess.run(["mv " + pathToDicom + '/*.nii.gz ' + dataFolder + '/' + filename + '/' + bidsDir + '/'], shell=True)
+    subprocess.run(["mv " + pathToDicom + '/*.bval ' + dataFolder + '/' + filename + '/' + bidsDir + '/'], shell=True)
+    subprocess.run(["find " + pathToDicom + " -type f ! -name '*.dcm' -exec rm {} \\;"], shell=True)
+
+def inprocess_fileops(dataFolder, filename, bidsDir):
+    pathToDicom = dataFolder + '/' + filename + '/' + bidsDir + '/' + 'dicom'
+    extract_nifti_from_dicom.organize_outputs(filename, bidsDir, pathToDicom)
+    extract_nifti_from_dicom.remove_non_dicom(pathToDicom)
+
+def time_per_subject(fileops, nbSubjects, nbDicom, nbOther):
+    dataFolder = tempfile.mkdtemp()
+    extract_nifti_from_dicom.dataFolder = dataFolder
+    try:
+        subjects = ['sub' + str(i) for i in range(nbSubjects)]
+        for filename in subjects:
+            create_subject(dataFolder, filename, 'diffusion', nbDicom, nbOther)
+        start = time.perf_counter()
+        for filename in subjects:
+            fileops(dataFolder, filename, 'diffusion')
+        return (time.perf_counter() - start) / nbSubjects
+    finally:
+        shutil.rmtree(dataFolder)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark shell against in-process post-conversion file operations.')
+    parser.add_argument('-n', '--subjects', type=int, default=20, help='Number of synthetic subjects.')
+    parser.add_argument('--dicom', type=int, default=31, help='Number of DICOM files per subject.')
+    parser.add_argument('--other', type=int, default=40, help='Number of non-DICOM files per subject.')
+    args = parser.parse_args()
+
+    before = time_per_subject(shell_fileops, args.subjects, args.dicom, args.other)
+    after = time_per_subject(inprocess_fileops, args.subjects, args.dicom, args.other)
+
+    print('shell commands  : ' + format(before * 1000, '.2f') + ' ms per subject')
+    print('in-process      : ' + format(after * 1000, '.2f') + ' ms per subject')
+    print('speedup         : ' + format(before / after, '.1f') + 'x')
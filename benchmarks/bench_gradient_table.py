@@ -0,0 +1,98 @@
+import io
+import os
+import sys
+import time
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import dicom_headers
+from gradient_table import GradientTable
+
+#
+# Benchmark of the gradient table handling of the preprocessing scripts on a corpus of synthetic
+# gradient tables (b0 volumes, 1 to 3 shells of random unit directions, random oblique orientations):
+# the text round trip (bvec written, read again, rotated with np.dot and written again at each step)
+# against the in-memory GradientTable (rotation and flip on the arrays, one bvec text at the end).
+# The results of both are checked to be equal (up to the rounding of the text files), as well as
+# the round trip of the tables through the FSL/Anima text format.
+#
+# python benchmarks/bench_gradient_table.py -n 200 --seed 0
+#
+
+def random_rotation(rng):
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    q = q * np.sign(np.diag(r))
+    return q if np.linalg.det(q) > 0 else -q
+
+# b-values, unit directions (null for the b0 volumes) and ImageOrientationPatient of one synthetic acquisition
+def synthetic_table(rng):
+    nbB0 = rng.integers(1, 8)
+    shells = rng.choice([500, 1000, 2000, 3000], size=rng.integers(1, 4), replace=False)
+    nbDirections = rng.integers(6, 100)
+    bvals = np.concatenate([np.zeros(nbB0)] + [np.full(nbDirections, shell) for shell in shells])
+    directions = rng.normal(size=(len(bvals) - nbB0, 3))
+    bvecs = np.concatenate([np.zeros((nbB0, 3)), directions / np.linalg.norm(directions, axis=1, keepdims=True)])
+    rotation = random_rotation(rng)
+    return bvals, bvecs, list(rotation[0]) + list(rotation[1])
+
+# previous version: the bvec of dcm2nii is read, rotated and written, then read again by the flip step
+def text_round_trip(folder, bvecs, iop):
+    np.savetxt(os.path.join(folder, 'dwi.bvec'), bvecs.transpose(), fmt="%.12f")
+    orMatrix = dicom_headers.orientation_matrix(iop)
+    corrected = np.dot(orMatrix.transpose(), np.loadtxt(os.path.join(folder, 'dwi.bvec')))
+    np.savetxt(os.path.join(folder, 'dwi_real.bvec'), corrected, fmt="%.12f")
+    flipped = np.loadtxt(os.path.join(folder, 'dwi_real.bvec'))
+    flipped[0] = -flipped[0]
+    np.savetxt(os.path.join(folder, 'dwi_flip.bvec'), flipped, fmt="%.12f")
+    return Path(folder, 'dwi_flip.bvec').read_text()
+
+def in_memory(bvals, bvecs, iop):
+    gradients = GradientTable(bvals, bvecs).to_real_coordinates(dicom_headers.orientation_matrix(iop))
+    return gradients.flip([0]).fsl_bvec_text()
+
+def check_corpus(corpus, folder):
+    for bvals, bvecs, iop in corpus:
+        table = GradientTable(bvals, bvecs)
+        Path(folder, 'check.bvec').write_text(table.fsl_bvec_text())
+        Path(folder, 'check.bval').write_text(table.fsl_bval_text())
+        reread = GradientTable.from_fsl(os.path.join(folder, 'check.bvec'), os.path.join(folder, 'check.bval'))
+        assert np.allclose(reread.bvecs, bvecs, atol=1e-12) and np.array_equal(reread.bvals, bvals)
+
+        rotation = dicom_headers.orientation_matrix(iop)
+        assert np.allclose(table.rotate(rotation).rotate(rotation.transpose()).bvecs, bvecs)
+        assert np.array_equal(table.flip([0, 2]).flip([0, 2]).bvecs, bvecs)
+        # the text round trip rounds the directions to 12 decimals at each step
+        previous = np.loadtxt(io.StringIO(text_round_trip(folder, bvecs, iop)))
+        assert np.allclose(previous, np.loadtxt(io.StringIO(in_memory(bvals, bvecs, iop))), rtol=0, atol=1e-11)
+
+def time_corpus(function, corpus, folder):
+    start = time.perf_counter()
+    for bvals, bvecs, iop in corpus:
+        if function is text_round_trip:
+            function(folder, bvecs, iop)
+        else:
+            function(bvals, bvecs, iop)
+    return (time.perf_counter() - start) / len(corpus)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the text round trip against the in-memory gradient table.')
+    parser.add_argument('-n', '--tables', type=int, default=200, help='Number of synthetic gradient tables.')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic corpus.')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    corpus = [synthetic_table(rng) for _ in range(args.tables)]
+    print(str(len(corpus)) + ' tables of ' + str(min(len(table[0]) for table in corpus)) + ' to ' + str(max(len(table[0]) for table in corpus)) + ' volumes')
+
+    with tempfile.TemporaryDirectory() as folder:
+        check_corpus(corpus, folder)
+        print('round trips and text outputs checked')
+        before = time_corpus(text_round_trip, corpus, folder)
+        after = time_corpus(in_memory, corpus, folder)
+
+    print('text round trip : ' + format(before * 1000, '.3f') + ' ms per table')
+    print('in memory       : ' + format(after * 1000, '.3f') + ' ms per table')
+    print('speedup         : ' + format(before / after, '.1f') + 'x')
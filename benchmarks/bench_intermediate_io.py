@@ -0,0 +1,85 @@
+import os
+import gzip
+import time
+import struct
+import argparse
+import tempfile
+import numpy as np
+
+#
+# Benchmark of the I/O of the intermediate images of the preprocessing scripts: a chain of stages
+# (eddy correction, reorientation, distortion correction, denoising, masking) where each stage reads
+# the 4D DWI written by the previous one and writes a new one, with compressed (.nii.gz) against
+# uncompressed (.nii, read by memory mapping) intermediate images. Only the I/O is timed, per stage.
+# The images are synthetic float32 volumes with noise, written as minimal NIfTI-1 files.
+#
+# python benchmarks/bench_intermediate_io.py --shape 96 96 60 40 --stages 5
+#
+
+HEADER_SIZE = 352
+
+def nifti_header(shape):
+    dim = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    header = bytearray(HEADER_SIZE)
+    struct.pack_into('<i', header, 0, 348)
+    struct.pack_into('<8h', header, 40, *dim)
+    struct.pack_into('<hh', header, 70, 16, 32) # float32
+    struct.pack_into('<8f', header, 76, *([1.0] * 8))
+    struct.pack_into('<f', header, 108, HEADER_SIZE)
+    header[344:348] = b'n+1\0'
+    return bytes(header)
+
+def header_shape(header):
+    dim = struct.unpack_from('<8h', header, 40)
+    return dim[1:dim[0] + 1]
+
+def write_image(path, data, level=6):
+    with (gzip.open(path, 'wb', compresslevel=level) if path.endswith('.gz') else open(path, 'wb')) as file:
+        file.write(nifti_header(data.shape))
+        file.write(np.asfortranarray(data, dtype='<f4').tobytes(order='F'))
+
+def read_image(path):
+    if path.endswith('.gz'):
+        with gzip.open(path, 'rb') as file:
+            content = file.read()
+        return np.frombuffer(content, dtype='<f4', offset=HEADER_SIZE).reshape(header_shape(content), order='F')
+    with open(path, 'rb') as file:
+        shape = header_shape(file.read(HEADER_SIZE))
+    return np.memmap(path, dtype='<f4', mode='r', offset=HEADER_SIZE, shape=shape, order='F')
+
+# time of the reads and writes of each stage of the chain, the processing is a copy of the image
+def run_chain(folder, image, extension, nbStages, level):
+    previous = os.path.join(folder, 'dwi' + extension)
+    write_image(previous, image, level)
+    times = []
+    for stage in range(nbStages):
+        current = os.path.join(folder, 'stage' + str(stage) + extension)
+        start = time.perf_counter()
+        data = np.array(read_image(previous))
+        write_image(current, data, level)
+        times.append(time.perf_counter() - start)
+        previous = current
+    return times
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark compressed against uncompressed intermediate images.')
+    parser.add_argument('--shape', type=int, nargs=4, default=[96, 96, 60, 40], help='Shape of the synthetic 4D DWI.')
+    parser.add_argument('--stages', type=int, default=5, help='Number of stages of the chain.')
+    parser.add_argument('--level', type=int, default=6, help='gzip compression level of the .nii.gz images (6 is the zlib default).')
+    parser.add_argument('--folder', type=str, default=None, help='Folder of the intermediate images (e.g. on the network filesystem), a temporary folder by default.')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    image = (1000 + 50 * rng.standard_normal(args.shape)).astype('<f4')
+    print('4D DWI of shape ' + 'x'.join(str(size) for size in args.shape) + ' (' + format(image.nbytes / 2**20, '.0f') + ' MiB), ' + str(args.stages) + ' stages')
+
+    with tempfile.TemporaryDirectory(dir=args.folder) as folder:
+        compressed = run_chain(folder, image, '.nii.gz', args.stages, args.level)
+        uncompressed = run_chain(folder, image, '.nii', args.stages, args.level)
+        sizes = [os.path.getsize(os.path.join(folder, 'dwi' + extension)) / 2**20 for extension in ['.nii.gz', '.nii']]
+        # the image read back through the memory map is the one written
+        assert np.array_equal(read_image(os.path.join(folder, 'stage' + str(args.stages - 1) + '.nii')), image)
+
+    print('.nii.gz : ' + format(np.mean(compressed) * 1000, '8.1f') + ' ms per stage, ' + format(sizes[0], '.0f') + ' MiB per image')
+    print('.nii    : ' + format(np.mean(uncompressed) * 1000, '8.1f') + ' ms per stage, ' + format(sizes[1], '.0f') + ' MiB per image')
+    print('speedup : ' + format(np.mean(compressed) / np.mean(uncompressed), '.1f') + 'x')
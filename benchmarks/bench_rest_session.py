@@ -0,0 +1,60 @@
+import sys
+import time
+import argparse
+import threading
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import shanoir_downloader
+
+#
+# Benchmark of the pooled session of shanoir_downloader against one connection per request.
+# A local HTTP server stands in for Shanoir, perform_rest_request is called with and without
+# the session created by shanoir_downloader.create_session and the requests/second are printed.
+#
+# python benchmarks/bench_rest_session.py -n 500
+#
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1' # keep-alive
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        body = b'{"content": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        return
+
+def requests_per_second(config, url, n):
+    start = time.perf_counter()
+    for i in range(n):
+        shanoir_downloader.perform_rest_request(config, 'get', url).raise_for_status()
+    return n / (time.perf_counter() - start)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark pooled session against per-call requests.')
+    parser.add_argument('-n', '--requests', type=int, default=500, help='Number of requests per run.')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:' + str(server.server_address[1]) + '/shanoir-ng/datasets/solr'
+
+    config = { 'proxies': None, 'verify': True, 'timeout': 60 }
+    per_call = requests_per_second(config, url, args.requests)
+
+    session_args = argparse.Namespace(retries=3, workers=1)
+    config['session'] = shanoir_downloader.create_session(session_args)
+    pooled = requests_per_second(config, url, args.requests)
+
+    server.shutdown()
+
+    print('per-call requests : ' + format(per_call, '.1f') + ' requests/s')
+    print('pooled session    : ' + format(pooled, '.1f') + ' requests/s')
+    print('speedup           : ' + format(pooled / per_call, '.2f') + 'x')
@@ -0,0 +1,215 @@
+import os
+import hashlib
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pydicom
+
+#
+# Reading of the DICOM headers needed by the diffusion preprocessing scripts
+# (modifiedAnimaDiffusionImagePreprocessing_Sebastien_flip.py and its nrrd variant).
+#
+# Only the headers are read (stop_before_pixels), restricted to the tags that are used
+# (specific_tags). Both the classic layout, where the tags are in the dataset itself, and the
+# enhanced multi-frame layout, where they are in the per-frame functional groups
+# sequence (5200,9230), are handled.
+#
+# The headers can be read by a pool of threads: on network filesystems the reads are
+# latency-bound, the threads overlap the latency of the files while the results are still
+# consumed in the order of the files.
+#
+# The values used by the scripts can be kept in an index next to the dicom folder
+# (see load_index), so that later runs do not read the headers again.
+#
+
+ACQUISITION_NUMBER = (0x0020, 0x0012)
+IMAGE_ORIENTATION_PATIENT = (0x0020, 0x0037)
+PER_FRAME_FUNCTIONAL_GROUPS = (0x5200, 0x9230)
+
+ORIENTATION_TAGS = [ACQUISITION_NUMBER, IMAGE_ORIENTATION_PATIENT, PER_FRAME_FUNCTIONAL_GROUPS]
+
+def read_header(dicom_file, tags):
+    return pydicom.dcmread(dicom_file, stop_before_pixels=True, specific_tags=tags)
+
+# yield the headers of the files in order, read by threads threads at most 2 * threads files ahead,
+# so that a consumer stopping early does not wait for the whole folder
+def iter_headers(dicom_files, tags, threads=1):
+    if threads <= 1:
+        for dicom_file in dicom_files:
+            yield read_header(dicom_file, tags)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=threads)
+    try:
+        files = iter(dicom_files)
+        pending = deque(executor.submit(read_header, dicom_file, tags) for dicom_file in itertools.islice(files, 2 * threads))
+        while len(pending) > 0:
+            image = pending.popleft().result()
+            for dicom_file in itertools.islice(files, 1):
+                pending.append(executor.submit(read_header, dicom_file, tags))
+            yield image
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def is_classic_layout(image):
+    return ACQUISITION_NUMBER in image
+
+def acquisition_number(image):
+    if is_classic_layout(image):
+        return image[ACQUISITION_NUMBER].value
+    return image[PER_FRAME_FUNCTIONAL_GROUPS].value[0][0x0021, 0x1101].value[0][ACQUISITION_NUMBER].value
+
+def image_orientation(image):
+    if is_classic_layout(image):
+        return image[IMAGE_ORIENTATION_PATIENT].value
+    return image[PER_FRAME_FUNCTIONAL_GROUPS].value[0][0x0020, 0x9116].value[0][IMAGE_ORIENTATION_PATIENT].value
+
+# ImageOrientationPatient of the first acquisition, the headers are read until it is found
+def find_orientation(dicom_files, threads=1):
+    for image in iter_headers(dicom_files, ORIENTATION_TAGS, threads):
+        if acquisition_number(image) == 1:
+            return image_orientation(image)
+    raise ValueError('No DICOM file with acquisition number 1 among the ' + str(len(dicom_files)) + ' given files')
+
+# rows are the row and column directions of the image and their cross product
+def orientation_matrix(img_plane_position):
+    V1 = np.array([float(img_plane_position[0]), float(img_plane_position[1]), float(img_plane_position[2])])
+    V2 = np.array([float(img_plane_position[3]), float(img_plane_position[4]), float(img_plane_position[5])])
+    V3 = np.cross(V1, V2)
+    return np.array([V1, V2, V3])
+
+B_VALUE = (0x0019, 0x100c)
+DIFFUSION_DIRECTIONALITY = (0x0019, 0x100d)
+DIFFUSION_GRADIENT_DIRECTION = (0x0019, 0x100e)
+
+GRADIENT_TAGS = [ACQUISITION_NUMBER, B_VALUE, DIFFUSION_DIRECTIONALITY, DIFFUSION_GRADIENT_DIRECTION, PER_FRAME_FUNCTIONAL_GROUPS]
+
+# acquisition number, b-value, directionality and raw gradient direction of one file
+# (Siemens CSA tags for the classic layout, MR diffusion sequence for the enhanced one)
+def gradient_entry(image):
+    if B_VALUE in image:
+        bval = float(image[B_VALUE].value)
+        directionality = image[DIFFUSION_DIRECTIONALITY].value
+        vecData = image[DIFFUSION_GRADIENT_DIRECTION].value if DIFFUSION_GRADIENT_DIRECTION in image else None
+    else:
+        diffusion = image[PER_FRAME_FUNCTIONAL_GROUPS].value[0][0x0018, 0x9117].value[0]
+        bval = float(diffusion[0x0018, 0x9087].value)
+        directionality = diffusion[0x0018, 0x9075].value
+        vecData = diffusion[0x0018, 0x9076].value[0][0x0018, 0x9089].value if (0x0018, 0x9076) in diffusion else None
+    return acquisition_number(image), bval, directionality, vecData
+
+# b-values and gradient directions of the files, as arrays indexed by acquisition number - 1
+# and sized from the largest acquisition number; non diffusion-weighted acquisitions get a null direction
+def read_gradient_table(dicom_files, threads=1):
+    entries = [gradient_entry(image) for image in iter_headers(dicom_files, GRADIENT_TAGS, threads)]
+    return gradient_table_from_entries(entries)
+
+# gradient direction of each entry, null for non diffusion-weighted entries;
+# binary CSA vectors (3 little-endian doubles each) are decoded at once, decoded values are stacked
+def decode_directions(entries):
+    directions = np.zeros((len(entries), 3))
+    weighted = [i for i, entry in enumerate(entries) if entry[2] != 'NONE' and entry[1] != 0 and entry[3] is not None]
+    binary = [i for i in weighted if isinstance(entries[i][3], bytes)]
+    decoded = [i for i in weighted if not isinstance(entries[i][3], bytes)]
+    if len(binary) > 0:
+        directions[binary] = np.frombuffer(b''.join(entries[i][3] for i in binary), dtype='<f8').reshape(-1, 3)
+    if len(decoded) > 0:
+        directions[decoded] = np.array([list(entries[i][3]) for i in decoded], dtype=float)
+    return directions
+
+def gradient_table_from_entries(entries):
+    acq_numbers = np.array([entry[0] for entry in entries], dtype=int)
+    bvals = np.array([entry[1] for entry in entries], dtype=float)
+    return gradient_table_from_arrays(acq_numbers, bvals, decode_directions(entries))
+
+# entries of the same acquisition (e.g. one file per slice) share their values, the last one is kept
+def gradient_table_from_arrays(acq_numbers, bvals, directions):
+    size = acq_numbers.max()
+    table_bvals = np.zeros(size)
+    table_bvecs = np.zeros((size, 3))
+    table_bvals[acq_numbers - 1] = bvals
+    table_bvecs[acq_numbers - 1] = directions
+    return table_bvals, table_bvecs
+
+# Index of the headers of a dicom folder, stored next to it in <dicom folder>_index.npz:
+# file names, acquisition numbers, ImageOrientationPatient, b-values and gradient directions.
+# It is rebuilt when the folder mtime or the name, size or mtime of one of the files changed.
+
+def list_dicom_files(dicom_folder):
+    return sorted(entry.path for entry in os.scandir(dicom_folder) if entry.is_file() and not entry.name.startswith('.'))
+
+def index_path(dicom_folder):
+    return os.path.normpath(dicom_folder) + '_index.npz'
+
+def folder_fingerprint(dicom_folder, dicom_files):
+    sha1 = hashlib.sha1(str(os.stat(dicom_folder).st_mtime_ns).encode())
+    for dicom_file in dicom_files:
+        stat = os.stat(dicom_file)
+        sha1.update((os.path.basename(dicom_file) + ':' + str(stat.st_size) + ':' + str(stat.st_mtime_ns) + '\n').encode())
+    return sha1.hexdigest()
+
+# acquisition number, orientation (NaN if absent) and gradient entry (b-value NaN if absent) of one file
+def index_entry(image):
+    try:
+        orientation = [float(value) for value in image_orientation(image)]
+    except KeyError:
+        orientation = [np.nan] * 6
+    try:
+        entry = gradient_entry(image)
+    except KeyError:
+        entry = (acquisition_number(image), np.nan, 'NONE', None)
+    return entry, orientation
+
+def build_index(dicom_folder, dicom_files=None, threads=1):
+    dicom_files = list_dicom_files(dicom_folder) if dicom_files is None else list(dicom_files)
+    if len(dicom_files) == 0:
+        raise ValueError('No DICOM file to index in ' + dicom_folder)
+    fingerprint = folder_fingerprint(dicom_folder, dicom_files)
+    entries, orientations = zip(*[index_entry(image) for image in iter_headers(dicom_files, ORIENTATION_TAGS + GRADIENT_TAGS, threads)])
+    index = {
+        'files': np.array([os.path.basename(dicom_file) for dicom_file in dicom_files]),
+        'acquisition_number': np.array([entry[0] for entry in entries], dtype=int),
+        'orientation': np.array(orientations, dtype=float),
+        'bval': np.array([entry[1] for entry in entries], dtype=float),
+        'bvec': decode_directions(entries),
+        'fingerprint': np.array(fingerprint),
+    }
+    path = index_path(dicom_folder)
+    # the index of a read-only data folder is only used by this run
+    try:
+        with open(path + '.tmp', 'wb') as file:
+            np.savez(file, **index)
+        os.replace(path + '.tmp', path)
+    except OSError as e:
+        print('Could not write the index of the DICOM headers to ' + path + ': ' + str(e))
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+    return index
+
+# the stored index if it is still valid for the folder, None otherwise
+def stored_index(dicom_folder, dicom_files=None):
+    dicom_files = list_dicom_files(dicom_folder) if dicom_files is None else list(dicom_files)
+    path = index_path(dicom_folder)
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as stored:
+        index = { key: stored[key] for key in stored.files }
+    if str(index['fingerprint']) != folder_fingerprint(dicom_folder, dicom_files):
+        return None
+    return index
+
+# the stored index if it is still valid for the folder, otherwise a new one (which is stored)
+def load_index(dicom_folder, dicom_files=None, threads=1):
+    dicom_files = list_dicom_files(dicom_folder) if dicom_files is None else list(dicom_files)
+    index = stored_index(dicom_folder, dicom_files)
+    return index if index is not None else build_index(dicom_folder, dicom_files, threads)
+
+def index_orientation(index):
+    first = np.flatnonzero(index['acquisition_number'] == 1)
+    if len(first) == 0:
+        raise ValueError('No DICOM file with acquisition number 1 in the index')
+    return index['orientation'][first[0]]
+
+def index_gradient_table(index):
+    return gradient_table_from_arrays(index['acquisition_number'], np.nan_to_num(index['bval']), index['bvec'])
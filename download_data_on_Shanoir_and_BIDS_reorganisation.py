@@ -84,13 +84,11 @@ if subjectToSeach != "*":
          '-so', 'id,ASC'])
 
     config = shanoir_downloader.initialize(args)
-    response = shanoir_downloader.solr_search(config, args)
 
-    if response.status_code == 200:
-        print('\n\nAvailable sequences for subject ' + subjectToSeach + ": ")
-        
-        for item in response.json()['content']:
-            print('Subject ID: ' + item['subjectName'] + ' - Dataset Name:' + item["datasetName"])
+    print('\n\nAvailable sequences for subject ' + subjectToSeach + ": ")
+
+    for item in shanoir_downloader.iter_search_results(config, args):
+        print('Subject ID: ' + item['subjectName'] + ' - Dataset Name:' + item["datasetName"])
 
 
 # Loop on each sequences entered in idSeq
@@ -113,15 +111,17 @@ for idS in idSeq:
             '-so', 'id,ASC'])
 
     config = shanoir_downloader.initialize(args)
-    response = shanoir_downloader.solr_search(config, args)
 
-    # From response, process the data
-    # Print the number of items found and a list of these items
-    if response.status_code == 200:
+    # From the search results, process the data page by page (all the pages are read, the next one is
+    # requested while the datasets of the current one are downloaded)
+    # Print the number of items found and a list of these items
+    nbItems = 0
+    for items in shanoir_downloader.iter_search_pages(config, args, prefetch=True):
+        nbItems += len(items)
         print('\n SEQUENCE == ' + dataOrganization[idS]['datasetName'] + '\nnumber of items found: ' +
-              str(len(response.json()['content'])))
+              str(len(items)))
 
-        for item in response.json()['content']:
+        for item in items:
             print('Subject ID: ' + item['subjectName'] +
               ' - Dataset Name:' + item["datasetName"] + 
               ' - ID: ' + item['id'])
@@ -132,12 +132,12 @@ for idS in idSeq:
         if input in ['y', 'Y', 'yes', 'Yes', 'YES']:
 
             # Invoke shanoir_downloader to download all the data
-            shanoir_downloader.download_search_results(config, args, response)
+            dl_archives = shanoir_downloader.download_search_items(config, args, items)
 
 
             # Organize in BIDS like specifications and rename files
             # Create subject directory
-            for item in response.json()['content']:
+            for item, dl_archive in zip(items, dl_archives):
 
                 # ID of the subject (sub-*)
                 subjID = item['subjectName'].replace(' ', '_').replace('LONGIDEP', 'lgp')
@@ -145,9 +145,10 @@ for idS in idSeq:
 
                 subjDir = pathOutputDir + '/' + subjID 
 
-                # Get the name of the downloaded archive
-                dl_archive = glob.glob(
-                    pathOutputDir + '/' + item['id'] + '*.zip')[0]
+                # The downloaded archive is the one returned by the downloader (None if the download failed)
+                if dl_archive is None:
+                    print('Nothing downloaded !')
+                    continue
 
                 # Create the directory of the subject
                 Path(subjDir).mkdir(parents=True, exist_ok=True)
@@ -168,7 +169,7 @@ for idS in idSeq:
                     if len(all_img) == 1:
                         os.rename(all_img[0], all_img[0].replace(
                             '.zip', '_run-1.zip'))
-                        os.rename(glob.glob(pathOutputDir + '/*.zip')[0], subjDir + '/'+dataOrganization[idS]['bidsDir']+'/' + subjID +
+                        os.rename(dl_archive, subjDir + '/'+dataOrganization[idS]['bidsDir']+'/' + subjID +
                                 '_' + dataOrganization[idS]['bidsName'] + '_run-2.zip')
                         
                     # Otherwise, if there is more than 2 images with 'run-*', rename the new one as a new run
@@ -187,8 +188,6 @@ for idS in idSeq:
                 else:
                     print('Nothing downloaded !')
     
-    elif response.status_code == 204:
+    if nbItems == 0:
         
         print('\nNo file found!')
-    else:
-        print('\nError returned by the request: status of the response = ' + response.status_code)
\ No newline at end of file
@@ -4,6 +4,7 @@ import sys
 import zipfile
 import os
 import glob
+from fnmatch import fnmatch
 from datetime import datetime
 
 #
@@ -225,6 +226,9 @@ shanoirID = 'dsebastien'
 
 # Type of data to download
 fileType = 'dicom' #Alternative: 'dicom'
+
+# Number of subjects combined with OR in a single search request
+subjectsPerSearch = 50
 ##############################################################################################
 # / TO ADAPT
 ##############################################################################################
@@ -234,129 +238,113 @@ fileType = 'dicom' #Alternative: 'dicom'
 parser = shanoir_downloader.create_arg_parser()
 shanoir_downloader.add_arguments(parser)
 
+# Arguments given by user at console or in the code
+if len(sys.argv) > 1:
+    args = parser.parse_args()
+else:
+    args = parser.parse_args(
+        ['-u', shanoirID,
+        '-d', 'shanoir.irisa.fr',
+        '-of', pathOutputDir,
+        '-em',
+        '-st', 'studyName:' + studyIDToSearch,
+        '-s', '200',
+        '-f', fileType,
+        '-so', 'id,ASC'])
 
-# If a subjectID is given, first display all sequences available for this subject;
-# this helps to check if there are new sequences in the protocol or if sequenceID is wrongly written
-for subject in subjectToSeach:
-    if subject != "*":
-        args = parser.parse_args(
-            ['-u', shanoirID,
-             '-d', 'shanoir.irisa.fr',
-             '-of', pathOutputDir,
-             '-em',
-             '-st', 'studyName:' + studyIDToSearch +
-             ' AND subjectName:' + subject,
-             '-s', '200',
-             '-f', fileType,
-             '-so', 'id,ASC'])
-
-        config = shanoir_downloader.initialize(args)
-        response = shanoir_downloader.solr_search(config, args)
-
-        if response.status_code == 200:
-            print('\n\nAvailable sequences for subject ' + subject + ": ")
-            
-            for item in response.json()['content']:
-                print('Subject ID: ' + item['subjectName'] + ' - Dataset Name:' + item["datasetName"])
+config = shanoir_downloader.initialize(args)
+
+
+# Cohort planning: search the datasets of all the subjects at once, with one request per subjectsPerSearch subjects
+# (subject IDs combined with OR) instead of two requests per subject, then index the datasets by subject locally
+cohortItems = shanoir_downloader.search_subjects(config, args, args.search_text, subjectToSeach, subjectsPerSearch)
+
+subjectIndex = {}
+for subject in dict.fromkeys(subjectToSeach):
+    subjectIndex[subject] = [item for item in cohortItems if fnmatch(item['subjectName'].lower(), subject.lower())]
+
+
+for subject, subjectItems in subjectIndex.items():
 
+    # First display all sequences available for this subject;
+    # this helps to check if there are new sequences in the protocol or if sequenceID is wrongly written
+    print('\n\nAvailable sequences for subject ' + subject + ": ")
 
-    # Loop on each sequences entered in idSeq
+    for item in subjectItems:
+        print('Subject ID: ' + item['subjectName'] + ' - Dataset Name:' + item["datasetName"])
+
+
+    # Loop on each sequences entered in idSeq
     for idS in idSeq:
-       
-        # Arguments given by user at console or in the code
-        if len(sys.argv) > 1:
-            args = parser.parse_args()
-        else:
-            args = parser.parse_args(
-                ['-u', shanoirID,
-                '-d', 'shanoir.irisa.fr',
-                '-of', pathOutputDir,
-                '-em',
-                '-st', 'studyName:' + studyIDToSearch + ' AND datasetName:\"' +
-                dataOrganization[idS]['datasetName'] +
-                '\" AND subjectName:' + subject,
-                '-s', '200',
-                '-f', fileType,
-                '-so', 'id,ASC'])
-
-        config = shanoir_downloader.initialize(args)
-        response = shanoir_downloader.solr_search(config, args)
-
-        # From response, process the data
-        # Print the number of items found and a list of these items
-        if response.status_code == 200:
-            print('\n SEQUENCE == ' + dataOrganization[idS]['datasetName'] + '\nnumber of items found: ' +
-                  str(len(response.json()['content'])))
-
-            for item in response.json()['content']:
-                print('Subject ID: ' + item['subjectName'] +
-                  ' - Dataset Name:' + item["datasetName"] + 
-                  ' - ID: ' + item['id'])
-
-            # Download all data?
-            input = 'y'  # input( 'Download everything? '  );
-
-            if input in ['y', 'Y', 'yes', 'Yes', 'YES']:
-
-                # Invoke shanoir_downloader to download all the data
-                shanoir_downloader.download_search_results(config, args, response)
-
-
-                # Organize in BIDS like specifications and rename files
-                # Create subject directory
-                for item in response.json()['content']:
-
-                    # ID of the subject (sub-*)
-                    subjID = item['subjectName'].replace(' ', '_').replace('LONGIDEP', 'lgp')
-                    print('Processing ' + subjID)
-
-                    subjDir = pathOutputDir + '/' + subjID 
-
-                    # Get the name of the downloaded archive
-                    #dl_archive = glob.glob(
-                    #    pathOutputDir + '/' + item['id'] + '*.zip')[0]
-                    dl_archive = glob.glob(pathOutputDir + '/' + '*.zip')[0]
-
-                    # Create the directory of the subject
-                    Path(subjDir).mkdir(parents=True, exist_ok=True)
-                    # And create te subdirectories (ignore if exists)
-                    Path(subjDir + '/' +
-                        dataOrganization[idS]['bidsDir']).mkdir(parents=True, exist_ok=True)
-                    
 
-                    # ***** Move Files*****
-                    # Check if the downloaded data has the good datasetName (should be always ok)
-                    if item['datasetName'].upper() == dataOrganization[idS]['datasetName'].upper():
-
-                        # Check if images for this sequence already exist in the subdirectory of the subject
-                        all_img = glob.glob(
-                            subjDir + '/' + dataOrganization[idS]['bidsDir'] + '/' + subjID + '_' + dataOrganization[idS]['bidsName'] + '*.zip')
-
-                        # If one image only exists, rename the previous one 'run-1' and the new one 'run-2'
-                        if len(all_img) == 1:
-                            os.rename(all_img[0], all_img[0].replace(
-                                '.zip', '_run-1.zip'))
-                            os.rename(glob.glob(pathOutputDir + '/*.zip')[0], subjDir + '/'+dataOrganization[idS]['bidsDir']+'/' + subjID +
-                                    '_' + dataOrganization[idS]['bidsName'] + '_run-2.zip')
-                            
-                        # Otherwise, if there is more than 2 images with 'run-*', rename the new one as a new run
-                        # (eg, if run-1 and run-2 already exist, rename the new image as run-3)
-                        elif len(all_img) > 1:
-                            os.rename( dl_archive, subjDir + '/'+dataOrganization[idS]['bidsDir']+'/' + subjID +
-                                    '_' + dataOrganization[idS]['bidsName'] + '_run-' + str(len(all_img)+1) + '.zip')
-                            
-                        # Otherwise, if no image already available, rename the image without 'run-?'
-                        else:
-                            #print('subjID == ' + subjID)
-
-                            os.rename( dl_archive, subjDir + '/'+dataOrganization[idS]['bidsDir']+'/' + subjID + '.zip')
-                            
-
-                    else:
-                        print('Nothing downloaded !')
-        
-        elif response.status_code == 204:
+        # Datasets of this subject for the sequence, taken from the index
+        items = [item for item in subjectItems if item['datasetName'].upper() == dataOrganization[idS]['datasetName'].upper()]
+
+        if len(items) == 0:
             
             print('\nNo file found!')
-        else:
-            print('\nError returned by the request: status of the response = ' + response.status_code)
+            continue
+
+        # Print the number of items found and a list of these items
+        print('\n SEQUENCE == ' + dataOrganization[idS]['datasetName'] + '\nnumber of items found: ' +
+              str(len(items)))
+
+        for item in items:
+            print('Subject ID: ' + item['subjectName'] +
+              ' - Dataset Name:' + item["datasetName"] + 
+              ' - ID: ' + item['id'])
+
+        # Download all data?
+        input = 'y'  # input( 'Download everything? '  );
+
+        if input in ['y', 'Y', 'yes', 'Yes', 'YES']:
+
+            # Invoke shanoir_downloader to download all the data
+            dl_archives = shanoir_downloader.download_search_items(config, args, items)
+
+
+            # Organize in BIDS like specifications and rename files
+            # Create subject directory
+            for item, dl_archive in zip(items, dl_archives):
+
+                # ID of the subject (sub-*)
+                subjID = item['subjectName'].replace(' ', '_').replace('LONGIDEP', 'lgp')
+                print('Processing ' + subjID)
+
+                subjDir = pathOutputDir + '/' + subjID 
+
+                # The downloaded archive is the one returned by the downloader (None if the download failed)
+                if dl_archive is None:
+                    print('Nothing downloaded !')
+                    continue
+
+                # Create the directory of the subject
+                Path(subjDir).mkdir(parents=True, exist_ok=True)
+                # And create te subdirectories (ignore if exists)
+                Path(subjDir + '/' +
+                    dataOrganization[idS]['bidsDir']).mkdir(parents=True, exist_ok=True)
+                
+
+                # ***** Move Files*****
+                # Check if images for this sequence already exist in the subdirectory of the subject
+                all_img = glob.glob(
+                    subjDir + '/' + dataOrganization[idS]['bidsDir'] + '/' + subjID + '_' + dataOrganization[idS]['bidsName'] + '*.zip')
+
+                # If one image only exists, rename the previous one 'run-1' and the new one 'run-2'
+                if len(all_img) == 1:
+                    os.rename(all_img[0], all_img[0].replace(
+                        '.zip', '_run-1.zip'))
+                    os.rename(dl_archive, subjDir + '/'+dataOrganization[idS]['bidsDir']+'/' + subjID +
+                            '_' + dataOrganization[idS]['bidsName'] + '_run-2.zip')
+                    
+                # Otherwise, if there is more than 2 images with 'run-*', rename the new one as a new run
+                # (eg, if run-1 and run-2 already exist, rename the new image as run-3)
+                elif len(all_img) > 1:
+                    os.rename( dl_archive, subjDir + '/'+dataOrganization[idS]['bidsDir']+'/' + subjID +
+                            '_' + dataOrganization[idS]['bidsName'] + '_run-' + str(len(all_img)+1) + '.zip')
+                    
+                # Otherwise, if no image already available, rename the image without 'run-?'
+                else:
+                    #print('subjID == ' + subjID)
+
+                    os.rename( dl_archive, subjDir + '/'+dataOrganization[idS]['bidsDir']+'/' + subjID + '.zip')
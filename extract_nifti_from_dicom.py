@@ -1,53 +1,248 @@
 import os
 import sys
+import json
+import glob
+import hashlib
+import shutil
 import zipfile
+import argparse
+import tempfile
 import subprocess
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 #
-# Script to extract DICOM .zip files and convert them to NIFTI using dcm2niix. 
+# Script to extract DICOM .zip files and convert them to NIFTI using dcm2niix.
 # Rename to appropriate file name.
-# Then, move files to one directory before and delete all files that are not 
+# Then, move files to one directory before and delete all files that are not
 # .dcm in the DICOM folder.
 #
 # It takes bidsDir as an argument when launched, so you should precise whether
 # you want to extract diffusion or structural folders.
 #
+# Subjects can be processed in parallel with --jobs N. The output of each subject
+# is written to data/<subject>/<bidsDir>/extract.log and the subjects that failed
+# are listed at the end of the run.
+#
+# With --dicom-only, only the DICOM files of the archive are extracted and only the
+# .nii.gz (and .bval for diffusion) produced by dcm2niix are kept, nothing else is
+# written to the data folder. With --scratch DIR, the DICOM files are extracted and
+# converted in a temporary folder of DIR (e.g. a tmpfs or a local disk), then the
+# DICOM files are copied to the dicom folder (unless --discard-dicom is given).
+#
+# A manifest (data/.extract_manifest_<bidsDir>.json) records the size, mtime and hash
+# of the archive and the size and mtime of the outputs of each converted subject.
+# Subjects whose archive and outputs did not change are skipped, use --force to
+# convert every subject again.
+#
+# With --build-index, the index of the DICOM headers used by the preprocessing scripts
+# is built next to the dicom folder after the conversion (see dicom_headers.py).
+#
 
 dataFolder = 'data'
 
-bidsDir = sys.argv[1]
+dcm2niix = os.path.expanduser('~/Projects/softwares/dcm2niix/bin/bin/dcm2niix')
+
+# DICOM members of the archive: .dcm files, or files with the DICM magic number after the 128 bytes preamble
+def is_dicom_member(zip_ref, info):
+    if info.is_dir():
+        return False
+    if info.filename.lower().endswith('.dcm'):
+        return True
+    with zip_ref.open(info) as member:
+        return member.read(132)[128:] == b'DICM'
+
+# move the file matching pattern in folder to destination (a rename when both are on the same filesystem),
+# fails if there is not exactly one
+def move_single_output(folder, pattern, destination):
+    outputs = glob.glob(os.path.join(folder, pattern))
+    if len(outputs) != 1:
+        raise Exception('Expected one ' + pattern + ' file from dcm2niix, found ' + str(len(outputs)))
+    shutil.move(outputs[0], destination)
+
+# files kept after the conversion of a subject
+def subject_outputs(filename, bidsDir):
+    subjectFolder = dataFolder + '/' + filename + '/' + bidsDir
+    if bidsDir == 'diffusion':
+        return [subjectFolder + '/dwi_' + filename + '.nii.gz', subjectFolder + '/encoding_' + filename + '.bval']
+    return [subjectFolder + '/T13D_' + filename + '.nii.gz']
+
+# move the dcm2niix outputs of outputFolder to the subject folder with their final names (see subject_outputs)
+def organize_outputs(filename, bidsDir, outputFolder):
+    outputs = subject_outputs(filename, bidsDir)
+    move_single_output(outputFolder, '*.nii.gz', outputs[0])
+    if bidsDir == 'diffusion':
+        move_single_output(outputFolder, '*.bval', outputs[1])
+
+# delete every file that is not a .dcm file in folder (and its subfolders) in a single walk, returns the number of deleted files
+def remove_non_dicom(folder):
+    removed = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if not name.endswith('.dcm'):
+                os.remove(os.path.join(root, name))
+                removed += 1
+    return removed
+
+# extract only the DICOM files and keep only the wanted dcm2niix outputs, see --dicom-only
+def extract_subject_dicom_only(filename, bidsDir, log, scratch=None, keepDicom=True):
+    subjectFolder = dataFolder + '/' + filename + '/' + bidsDir
+    pathToDicom = subjectFolder + '/' + 'dicom'
+
+    # the work folder holds the dcm2niix outputs (and the DICOM files when a scratch folder is used)
+    workFolder = tempfile.mkdtemp(prefix=filename + '_', dir=scratch if scratch else subjectFolder)
+    try:
+        dicomFolder = workFolder + '/dicom' if scratch else pathToDicom
+        outputFolder = workFolder + '/nifti'
+        os.makedirs(outputFolder)
+
+        with zipfile.ZipFile(subjectFolder + '/' + filename + '.zip', 'r') as zip_ref:
+            members = [info for info in zip_ref.infolist() if is_dicom_member(zip_ref, info)]
+            for info in members:
+                zip_ref.extract(info, path=dicomFolder)
+        print(len(members), 'DICOM files extracted to', dicomFolder, file=log, flush=True)
+
+        # conversion to NIFTI using dcm2niix, written to the work folder
+        subprocess.run([dcm2niix, '-m', '1', '-z', '1', '-o', outputFolder, dicomFolder],
+                       stdout=log, stderr=subprocess.STDOUT, check=True)
+
+        # keep the .nii.gz (and .bval for diffusion) with their final names, the other outputs are removed with the work folder
+        organize_outputs(filename, bidsDir, outputFolder)
+
+        if scratch and keepDicom:
+            shutil.copytree(dicomFolder, pathToDicom, dirs_exist_ok=True)
+    finally:
+        shutil.rmtree(workFolder, ignore_errors=True)
+
+def subject_archive(filename, bidsDir):
+    return dataFolder + '/' + filename + '/' + bidsDir + '/' + filename + '.zip'
+
+def file_state(path):
+    stat = os.stat(path)
+    return { 'size': stat.st_size, 'mtime': stat.st_mtime }
+
+def file_hash(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1024 * 1024), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+# manifest entry of a converted subject
+def subject_record(filename, bidsDir, archiveHash):
+    archive = dict(file_state(subject_archive(filename, bidsDir)), sha256=archiveHash)
+    return { 'archive': archive, 'outputs': { path: file_state(path) for path in subject_outputs(filename, bidsDir) } }
 
-for filename in os.listdir(dataFolder):
+def outputs_unchanged(record):
+    return all(os.path.exists(path) and file_state(path) == state for path, state in record['outputs'].items())
+
+# only stats the archive and the outputs, the archive is hashed by process_subject if its size or mtime changed
+def is_up_to_date(record, filename, bidsDir):
+    archive = subject_archive(filename, bidsDir)
+    if record is None or not os.path.exists(archive):
+        return False
+    state = file_state(archive)
+    return state['size'] == record['archive']['size'] and state['mtime'] == record['archive']['mtime'] and outputs_unchanged(record)
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def save_manifest(path, manifest):
+    with open(path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+# convert the subject unless its archive has the same hash as in the manifest record (e.g. downloaded again) and
+# its outputs are unchanged, returns the new manifest record and whether the subject was converted
+def process_subject(filename, bidsDir, record=None, dicomOnly=False, scratch=None, keepDicom=True, buildIndex=False):
+    archiveHash = file_hash(subject_archive(filename, bidsDir))
+    if record is not None and record['archive']['sha256'] == archiveHash and outputs_unchanged(record):
+        return subject_record(filename, bidsDir, archiveHash), False
+    extract_subject(filename, bidsDir, dicomOnly, scratch, keepDicom, buildIndex)
+    return subject_record(filename, bidsDir, archiveHash), True
+
+# extract, convert and rename the files of one subject, the output of the commands goes to the log of the subject
+def extract_subject(filename, bidsDir, dicomOnly=False, scratch=None, keepDicom=True, buildIndex=False):
     pathToDicom = dataFolder + '/' + filename + '/' + bidsDir + '/' + 'dicom' # the last should be 'dicom'
-    
-    print(filename)
+
+    with open(dataFolder + '/' + filename + '/' + bidsDir + '/extract.log', 'w') as log:
+        print(filename, file=log, flush=True)
+        if dicomOnly or scratch:
+            extract_subject_dicom_only(filename, bidsDir, log, scratch, keepDicom)
+        else:
+            extract_subject_in_place(filename, bidsDir, log)
+
+        if buildIndex and os.path.isdir(pathToDicom):
+            build_dicom_index(pathToDicom, log)
+    return filename
+
+# index of the DICOM headers for the preprocessing scripts, imported here as it needs pydicom
+def build_dicom_index(pathToDicom, log):
+    import dicom_headers
+    dicomFiles = dicom_headers.list_dicom_files(pathToDicom)
+    if len(dicomFiles) == 0:
+        print('No DICOM file directly in', pathToDicom + ', no index built', file=log, flush=True)
+        return
+    dicom_headers.build_index(pathToDicom, dicomFiles)
+    print('DICOM headers index written to', dicom_headers.index_path(pathToDicom), file=log, flush=True)
+
+# extract the whole archive to the dicom folder, convert there and remove what is not needed
+def extract_subject_in_place(filename, bidsDir, log):
+    pathToDicom = dataFolder + '/' + filename + '/' + bidsDir + '/' + 'dicom'
+
     with zipfile.ZipFile(dataFolder + '/' + filename + '/' + bidsDir + '/' + filename + '.zip', 'r') as zip_ref:
         zip_ref.extractall(path=pathToDicom)
-        
+
     # conversion to NIFTI using dcm2niix
-    subprocess.run(["~/Projects/softwares/dcm2niix/bin/bin/dcm2niix -m 1 -z 1 " + pathToDicom], 
-                   shell=True)
-    
-    # rename .nii.gz and .bval files
-    subprocess.run(["mv " '~/Projects/longidep/scripts/' + pathToDicom + '/*.bval ' + '~/Projects/longidep/scripts/' + pathToDicom + '/encoding_' + filename + '.bval'], 
-                   shell=True)
-    if bidsDir == 'diffusion':
-        subprocess.run(["mv " '~/Projects/longidep/scripts/' + pathToDicom + '/*.nii.gz ' + '~/Projects/longidep/scripts/' + pathToDicom + '/dwi_' + filename + '.nii.gz'], 
-                       shell=True)
-    else:
-        subprocess.run(["mv " '~/Projects/longidep/scripts/' + pathToDicom + '/*.nii.gz ' + '~/Projects/longidep/scripts/' + pathToDicom + '/T13D_' + filename + '.nii.gz'], 
-                       shell=True)
-    
-    # move .nii.gz to one directory before
-    subprocess.run(["mv " '~/Projects/longidep/scripts/' + pathToDicom + '/*.nii.gz ' + '~/Projects/longidep/scripts/' + dataFolder + '/' + filename + '/' + bidsDir + '/'], 
-                   shell=True)
-    
-    if bidsDir == 'diffusion':
-        # move .bval to one directory before
-        subprocess.run(["mv " '~/Projects/longidep/scripts/' + pathToDicom + '/*.bval ' + '~/Projects/longidep/scripts/' + dataFolder + '/' + filename + '/' + bidsDir + '/'], 
-                       shell=True)
-    
+    subprocess.run([dcm2niix, '-m', '1', '-z', '1', pathToDicom],
+                   stdout=log, stderr=subprocess.STDOUT, check=True)
+
+    # rename .nii.gz and .bval files and move them to one directory before
+    organize_outputs(filename, bidsDir, pathToDicom)
+
     # delete files that are not .dcm in dicomFolder
-    subprocess.run(["find " '~/Projects/longidep/scripts/' + pathToDicom + " -type f ! -name '*.dcm' -exec rm {} \;"], 
-                   shell=True)
-    
+    print(remove_non_dicom(pathToDicom), 'files that are not .dcm removed from', pathToDicom, file=log, flush=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract DICOM .zip files of every subject of the data folder and convert them to NIFTI using dcm2niix.')
+    parser.add_argument('bidsDir', help='Subdirectory of the subjects containing the sequences (e.g. diffusion or structural).')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of subjects processed in parallel.')
+    parser.add_argument('--dicom-only', action='store_true', help='Extract only the DICOM files of the archives and keep only the wanted dcm2niix outputs.')
+    parser.add_argument('--scratch', type=str, default=None, help='Folder (e.g. tmpfs or local disk) where the DICOM files are extracted and converted, implies --dicom-only.')
+    parser.add_argument('--discard-dicom', action='store_true', help='With --scratch, do not copy the DICOM files to the dicom folder of the subject.')
+    parser.add_argument('--force', action='store_true', help='Convert every subject, even the ones that are up to date in the manifest.')
+    parser.add_argument('--build-index', action='store_true', help='Build the index of the DICOM headers used by the preprocessing scripts after the conversion.')
+    args = parser.parse_args()
+
+    # skip the files of the data folder (e.g. the shanoir_downloader cache), only subject folders are processed
+    subjects = [filename for filename in sorted(os.listdir(dataFolder)) if os.path.isdir(dataFolder + '/' + filename)]
+
+    manifestPath = dataFolder + '/.extract_manifest_' + args.bidsDir + '.json'
+    manifest = {} if args.force else load_manifest(manifestPath)
+    subjectsToProcess = [filename for filename in subjects if not is_up_to_date(manifest.get(filename), filename, args.bidsDir)]
+    print(str(len(subjects) - len(subjectsToProcess)) + ' subjects up to date, ' + str(len(subjectsToProcess)) + ' to process')
+
+    # a failure (corrupted archive, dcm2niix error...) is reported at the end instead of stopping the other subjects
+    failures = {}
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = { executor.submit(process_subject, filename, args.bidsDir, manifest.get(filename), args.dicom_only, args.scratch, not args.discard_dicom, args.build_index): filename for filename in subjectsToProcess }
+        for future in as_completed(futures):
+            filename = futures[future]
+            try:
+                manifest[filename], converted = future.result()
+                # saved after each subject so that an interrupted run keeps what was done
+                save_manifest(manifestPath, manifest)
+                print(filename, 'done' if converted else 'unchanged')
+            except Exception as e:
+                failures[filename] = e
+                print(filename, 'failed:', e)
+
+    print(str(len(subjectsToProcess) - len(failures)) + '/' + str(len(subjectsToProcess)) + ' subjects processed')
+    if len(failures) > 0:
+        print('Failed subjects (see data/<subject>/' + args.bidsDir + '/extract.log):')
+        for filename, error in sorted(failures.items()):
+            print('  ' + filename + ': ' + str(error))
+        sys.exit(1)
@@ -0,0 +1,63 @@
+import io
+import numpy as np
+
+#
+# Gradient table of a DWI (b-values and gradient directions) kept in memory by the preprocessing
+# scripts, with the orientation matrix of the image when it is known (see dicom_headers.orientation_matrix).
+#
+# The directions are stored as an (N, 3) array: rotations and flips apply to all of them at once.
+# Tables are read from and written to the FSL/Anima text format (bvec: 3 rows of N values,
+# bval: 1 row of N values) only where a file is needed by an Anima tool.
+#
+
+BVEC_FORMAT = "%.12f"
+
+class GradientTable:
+    def __init__(self, bvals, bvecs, orientation=None):
+        self.bvecs = np.array(bvecs, dtype=float).reshape(-1, 3)
+        self.bvals = np.zeros(len(self.bvecs)) if bvals is None else np.array(bvals, dtype=float).reshape(-1)
+        self.orientation = None if orientation is None else np.array(orientation, dtype=float)
+        if len(self.bvals) != len(self.bvecs):
+            raise ValueError(str(len(self.bvals)) + ' b-values for ' + str(len(self.bvecs)) + ' gradient directions')
+
+    def __len__(self):
+        return len(self.bvecs)
+
+    # table of a bvec file (and of a bval file if given), in the FSL/Anima format
+    @classmethod
+    def from_fsl(cls, bvecFile, bvalFile=None, orientation=None):
+        bvecs = np.loadtxt(bvecFile, ndmin=2)
+        if bvecs.shape[0] != 3:
+            raise ValueError('Expected 3 rows of gradient directions in ' + str(bvecFile) + ', found ' + str(bvecs.shape[0]))
+        bvals = None if bvalFile is None else np.loadtxt(bvalFile, ndmin=1)
+        return cls(bvals, bvecs.transpose(), orientation)
+
+    def fsl_bvec_text(self):
+        text = io.StringIO()
+        np.savetxt(text, self.bvecs.transpose(), fmt=BVEC_FORMAT)
+        return text.getvalue()
+
+    def fsl_bval_text(self):
+        text = io.StringIO()
+        np.savetxt(text, self.bvals.reshape(1, -1), fmt="%g")
+        return text.getvalue()
+
+    # directions multiplied by the 3x3 matrix, e.g. a rotation
+    def rotate(self, matrix):
+        return GradientTable(self.bvals, self.bvecs @ np.asarray(matrix, dtype=float).transpose(), self.orientation)
+
+    # directions with the components of the given axes (0: x, 1: y, 2: z) negated
+    def flip(self, axes):
+        signs = np.ones(3)
+        signs[list(axes)] = -1
+        return GradientTable(self.bvals, self.bvecs * signs, self.orientation)
+
+    # directions from the image coordinates (e.g. the dcm2nii bvec) to the real coordinates,
+    # with the orientation matrix of the image
+    def to_real_coordinates(self, orientation=None):
+        orientation = self.orientation if orientation is None else np.asarray(orientation, dtype=float)
+        if orientation is None:
+            raise ValueError('No orientation matrix to put the gradient directions in real coordinates')
+        table = self.rotate(orientation.transpose())
+        table.orientation = orientation
+        return table
@@ -5,10 +5,9 @@ import sys
 import argparse
 import tempfile
 #import pydicom
-import numpy as np
-import struct
-import glob
-import pydicom
+import dicom_headers
+import anima_pipeline
+import gradient_table
 
 if sys.version_info[0] > 2:
     import configparser as ConfParser
@@ -17,7 +16,7 @@ else:
 
 import os
 import shutil
-from subprocess import call
+import functools
 
 configFilePath = os.path.expanduser("~") + "/.anima/config.txt"
 if not os.path.exists(configFilePath):
@@ -39,6 +38,8 @@ parser.add_argument('-g', '--grad', type=str, default="", help="DWI gradients fi
 parser.add_argument('-r', '--reverse', type=str, default="", help="Reversed PED B0 image")
 parser.add_argument('-d', '--direction', type=int, default=1, help="PED direction (0: x, 1: y, 2: z)")
 parser.add_argument('-D', '--dicom-folder', type=str, default="", help="Dicom file to put dcm2nii bvec file to real coordinates")
+parser.add_argument('--dicom-threads', type=int, default=8, help="Number of threads reading the DICOM headers of the dicom folder")
+parser.add_argument('--no-dicom-index', action='store_true', help="Read the DICOM headers instead of using (and updating) the index stored next to the dicom folder")
 parser.add_argument('--no-disto-correction', default=False, help="Do not perform distortion correction")
 parser.add_argument('--no-denoising', default=False, help="Do not perform NL-Means denoising")
 parser.add_argument('-t', '--t1', type=str, default="", help="T1 image for brain masking (B0 used if not provided)")
@@ -47,7 +48,21 @@ parser.add_argument('--no-eddy-correction', default=False,
                     help="Do not perform Eddy current distortion correction")
 parser.add_argument('--register-t1-on-dwi', action='store_true',
                     help="T1 registration on DWI is needed as they were not acquired in the same session")
+parser.add_argument('--t1-init', type=str, default=None, choices=["0", "1", "none"],
+                    help="Initialisation type (-I) of the T1 registrations, none to use the Anima default (1 with --register-t1-on-dwi, 0 otherwise)")
 parser.add_argument('-i', '--input', type=str, required=True, help='DWI file to process')
+parser.add_argument('--force', action='store_true', help="Run every stage, even the ones up to date in the checkpoint (<DWI prefix>_stages.json)")
+parser.add_argument('--format', type=str, default="nii.gz", choices=["nii.gz", "nrrd"],
+                    help="Format of the brain masks and of the masked T1 image")
+parser.add_argument('--intermediate-format', type=str, default="nii", choices=["nii", "nrrd"],
+                    help="Format of the intermediate images of the tmp folder: nii (uncompressed, only the final outputs are compressed) or nrrd")
+parser.add_argument('--scratch', type=str, default="",
+                    help="Folder (e.g. $TMPDIR or a local disk) of the intermediate images, next to the DWI file by default")
+parser.add_argument('--keep-scratch-on-failure', action='store_true',
+                    help="Keep the intermediate images when a stage fails, so that the next run starts from the failed stage (default)")
+parser.add_argument('--remove-scratch-on-failure', action='store_true',
+                    help="Remove the intermediate images when a stage fails, the next run starts again from the first stage writing them")
+parser.add_argument('--cpu-budget', type=int, default=os.cpu_count(), help="Number of CPUs shared by the stages running concurrently")
 args = parser.parse_args()
 
 #tmpFolder = tempfile.mkdtemp()
@@ -56,24 +71,35 @@ dwiImage = args.input
 
 PatientFolder=os.path.dirname(args.input);
 
-tmpFolder=PatientFolder +'/tmp/'
-try:
-    os.stat(tmpFolder)
-except:
-    os.mkdir(tmpFolder)
-
 dwiImagePrefix = os.path.splitext(dwiImage)[0]
 if os.path.splitext(dwiImage)[1] == '.gz':
     dwiImagePrefix = os.path.splitext(dwiImagePrefix)[0]
 
+# only the final outputs are written next to the DWI file, the tmp folder is created and removed by scratch_folder;
+# it is specific to the DWI file (<DWI prefix>_tmp), so that the runs on the DWI files of a patient folder do not share it
+if args.scratch == "":
+    tmpFolder = dwiImagePrefix + "_tmp"
+else:
+    tmpFolder = os.path.join(args.scratch, os.path.basename(dwiImagePrefix) + "_tmp")
 
 tmpDWIImagePrefix = os.path.join(tmpFolder, os.path.basename(dwiImagePrefix))
+tmpExtension = anima_pipeline.INTERMEDIATE_EXTENSIONS[args.intermediate_format]
+maskExtension = "." + args.format
+
+# -I of the T1 registrations, not given with --t1-init none
+t1InitType = args.t1_init if args.t1_init is not None else ("1" if args.register_t1_on_dwi else "0")
+t1InitArgs = [] if t1InitType == "none" else ["-I", t1InitType]
 
 outputImage = dwiImage
 outputBVec = args.grad
 
+# stages completed by a previous run with the same inputs are skipped
+checkpoint = anima_pipeline.load_checkpoint(dwiImagePrefix + "_stages.json", args.force)
+# the stages are declared with their inputs and outputs below, and run at the end as a graph
+stages = []
+
 if not (args.dicom_folder == ""):
-    dicom = glob.glob(os.path.join(args.dicom_folder, "*"))
+    dicom = dicom_headers.list_dicom_files(args.dicom_folder)
 else:
     dicom = ""
 
@@ -83,74 +109,29 @@ if not (dicom == "") and not (args.grad == ""):
     # back in real coordinates. This assumes dcm2nii worked for gradient extraction which is not always the case.
     # If not, use the dicom folder option In any case, it works only for Siemens scanners though as far as I know
 
-    img_plane_position = np.zeros(3)
-    for dicom_file in dicom:
-        image = pydicom.read_file(dicom_file)
-        dicomBaseFormat = [0x0020, 0x0012] in image
-
-        if dicomBaseFormat:
-            acq_number = image[0x0020, 0x0012].value
-            if acq_number == 1:
-                img_plane_position = image[0x0020, 0x0037].value
-        else:
-            acq_number = image[0x5200, 0x9230].value[0][0x0021, 0x1101].value[0][0x0020, 0x0012].value
-            if acq_number == 1:
-                img_plane_position = image[0x5200, 0x9230].value[0][0x0020, 0x9116].value[0][0x0020, 0x0037].value
-
-    V1 = np.array([float(img_plane_position[0]), float(img_plane_position[1]), float(img_plane_position[2])])
-    V2 = np.array([float(img_plane_position[3]), float(img_plane_position[4]), float(img_plane_position[5])])
-    V3 = np.cross(V1, V2)
-
-    orMatrix = np.array([V1, V2, V3])
-    bvecs = np.loadtxt(args.grad)
-    bvecs_corrected = np.dot(orMatrix.transpose(), bvecs)
-
-    np.savetxt(dwiImagePrefix + "_real.bvec", bvecs_corrected, fmt="%.12f")
+    # only the first acquisition is needed: the index is used if a previous run stored it, it is not built here
+    dicomIndex = None if args.no_dicom_index else dicom_headers.stored_index(args.dicom_folder, dicom)
+    if dicomIndex is not None:
+        img_plane_position = dicom_headers.index_orientation(dicomIndex)
+    else:
+        # headers only, stops at the file of the first acquisition
+        img_plane_position = dicom_headers.find_orientation(dicom, args.dicom_threads)
+    orMatrix = dicom_headers.orientation_matrix(img_plane_position)
+    # the table stays in memory, the text file is only written for the Anima tools
+    gradients = gradient_table.GradientTable.from_fsl(args.grad, args.bval).to_real_coordinates(orMatrix)
+
+    anima_pipeline.write_if_changed(dwiImagePrefix + "_real.bvec", gradients.fsl_bvec_text())
     outputBVec = dwiImagePrefix + "_real.bvec"
 
 elif not (dicom == "") and (args.grad == ""):
-    bvecs_corrected = [np.zeros(3)] * len(dicom)
-    for dicom_file in dicom:
-        image = pydicom.read_file(dicom_file)
-        dicomBaseFormat = [0x0019, 0x100c] in image
-
-        if dicomBaseFormat:
-            bval = float(image[0x0019, 0x100c].value)
-            directionality = image[0x0019, 0x100d].value
-        else:
-            bval = image[0x5200, 0x9230].value[0][0x0018, 0x9117].value[0][0x0018, 0x9087].value
-            directionality = image[0x5200, 0x9230].value[0][0x0018, 0x9117].value[0][0x0018, 0x9075].value
-
-        if directionality == 'NONE' or bval == 0:
-            bvec = [0, 0, 0]
-        else:
-            vec = []
-
-            if dicomBaseFormat:
-                vecData = image[0x0019, 0x100e].value
-            else:
-                vecData = image[0x5200, 0x9230].value[0][0x0018,0x9117].value[0][0x0018,0x9076].value[0][0x0018,0x9089].value
-
-            if type(vecData) == type(list()):
-                vec = np.array(vecData)
-            else:
-                buff = struct.unpack('ddd', vecData)
-                vec = np.array(buff)
-
-            bvec = np.zeros(3)
-            bvec = vec
-
-        if dicomBaseFormat:
-            acq_number = image[0x0020, 0x0012].value
-        else:
-            acq_number = image[0x5200, 0x9230].value[0][0x0021, 0x1101].value[0][0x0020, 0x0012].value
-
-        bvecs_corrected[acq_number - 1] = bvec
-
-    bvecs_corrected = np.array(bvecs_corrected)
-    # shorten length of dimension to acq_number (should be 31)
-    bvecs_corrected = bvecs_corrected[:31, :]
-    np.savetxt(dwiImagePrefix + "_real.bvec", bvecs_corrected.transpose(), fmt="%.12f")
+    # the table is sized from the acquisition numbers found in the files;
+    # values of the headers kept from a previous run, read again only if the folder changed
+    dicomIndex = None if args.no_dicom_index else dicom_headers.load_index(args.dicom_folder, dicom, args.dicom_threads)
+    if dicomIndex is not None:
+        gradients = gradient_table.GradientTable(*dicom_headers.index_gradient_table(dicomIndex))
+    else:
+        gradients = gradient_table.GradientTable(*dicom_headers.read_gradient_table(dicom, args.dicom_threads))
+    anima_pipeline.write_if_changed(dwiImagePrefix + "_real.bvec", gradients.fsl_bvec_text())
     outputBVec = dwiImagePrefix + "_real.bvec"
 
 if outputBVec == "":
@@ -161,18 +142,19 @@ if outputBVec == "":
 # Eddy current first
 if args.no_eddy_correction is False:
     eddyCorrectionCommand = [animaDir + "animaEddyCurrentCorrection", "-i", dwiImage, "-I", outputBVec, "-o",
-                             tmpDWIImagePrefix + "_eddy_corrected.nrrd", \
+                             tmpDWIImagePrefix + "_eddy_corrected" + tmpExtension, \
                              "-O", tmpDWIImagePrefix + "_eddy_corrected.bvec", "-d", str(args.direction)]
-    call(eddyCorrectionCommand)
+    anima_pipeline.add_stage(stages, "eddy_correction", eddyCorrectionCommand, [dwiImage, outputBVec],
+                             [tmpDWIImagePrefix + "_eddy_corrected" + tmpExtension, tmpDWIImagePrefix + "_eddy_corrected.bvec"])
 
-    outputImage = tmpDWIImagePrefix + "_eddy_corrected.nrrd"
+    outputImage = tmpDWIImagePrefix + "_eddy_corrected" + tmpExtension
     outputBVec = tmpDWIImagePrefix + "_eddy_corrected.bvec"
 
 #Then re-orient image to be axial first
-dwiReorientCommand = [animaDir + "animaConvertImage", "-i", outputImage, "-o", tmpDWIImagePrefix + "_or.nrrd", "-R",
+dwiReorientCommand = [animaDir + "animaConvertImage", "-i", outputImage, "-o", tmpDWIImagePrefix + "_or" + tmpExtension, "-R",
                       "AXIAL"]
-call(dwiReorientCommand)
-outputImage = tmpDWIImagePrefix + "_or.nrrd"
+anima_pipeline.add_stage(stages, "reorientation", dwiReorientCommand, [outputImage], [tmpDWIImagePrefix + "_or" + tmpExtension])
+outputImage = tmpDWIImagePrefix + "_or" + tmpExtension
 
 #Extract brain from T1 image if present (used for further processing)
 if (args.no_disto_correction is False or args.no_brain_masking is False) and not args.t1 == "":
@@ -180,50 +162,57 @@ if (args.no_disto_correction is False or args.no_brain_masking is False) and not
 	if os.path.splitext(args.t1)[1] == '.gz':
 		T1Prefix = os.path.splitext(T1Prefix)[0]
 
-	brainExtractionCommand = ["python", animaScriptsDir + "brain_extraction/animaAtlasBasedBrainExtraction.py", "-i", args.t1, "-m", T1Prefix + "_brainMask.nii.gz", "-b", T1Prefix + "_masked.nii.gz"]
-	call(brainExtractionCommand)
+	brainExtractionCommand = ["python", animaScriptsDir + "brain_extraction/animaAtlasBasedBrainExtraction.py", "-i", args.t1, "-m", T1Prefix + "_brainMask" + maskExtension, "-b", T1Prefix + "_masked" + maskExtension]
+	anima_pipeline.add_stage(stages, "t1_brain_extraction", brainExtractionCommand, [args.t1],
+	                         [T1Prefix + "_brainMask" + maskExtension, T1Prefix + "_masked" + maskExtension])
 
 # Then susceptibility distortion
 if args.no_disto_correction is False:
     if not (args.reverse == ""):
         b0ExtractCommand = [animaDir + "animaCropImage", "-i", outputImage, "-t", "0", "-T", "0", "-o",
-                            tmpDWIImagePrefix + "_B0.nrrd"]
-        call(b0ExtractCommand)
+                            tmpDWIImagePrefix + "_B0" + tmpExtension]
+        anima_pipeline.add_stage(stages, "b0_extraction", b0ExtractCommand, [outputImage], [tmpDWIImagePrefix + "_B0" + tmpExtension], threads=1)
 
         idTrsfName = os.path.join(animaDataDir, "id.txt")
         idTrsfXmlName = os.path.join(tmpFolder, "id.xml")
         idGenCommand = [animaDir + "animaTransformSerieXmlGenerator", "-i", idTrsfName, "-o", idTrsfXmlName]
-        call(idGenCommand)
+        anima_pipeline.add_stage(stages, "identity_transform", idGenCommand, [idTrsfName], [idTrsfXmlName], threads=1)
 
         resampleB0PACommand = [animaDir + "animaApplyTransformSerie", "-i", args.reverse, "-t", idTrsfXmlName, "-o",
-                                                   tmpDWIImagePrefix + "_B0_Reverse.nrrd", "-g", tmpDWIImagePrefix + "_B0.nrrd"]
-        call(resampleB0PACommand)
+                                                   tmpDWIImagePrefix + "_B0_Reverse" + tmpExtension, "-g", tmpDWIImagePrefix + "_B0" + tmpExtension]
+        anima_pipeline.add_stage(stages, "reverse_b0_resampling", resampleB0PACommand,
+                                 [args.reverse, idTrsfXmlName, tmpDWIImagePrefix + "_B0" + tmpExtension], [tmpDWIImagePrefix + "_B0_Reverse" + tmpExtension])
 
         initCorrectionCommand = [animaDir + "animaDistortionCorrection", "-s", "2", "-d", str(args.direction), \
-                                                     "-f", tmpDWIImagePrefix + "_B0.nrrd", "-b", tmpDWIImagePrefix + "_B0_Reverse.nrrd",
-                                                     "-o", tmpDWIImagePrefix + "_init_correction_tr.nrrd"]
-        call(initCorrectionCommand)
-        bmCorrectionCommand = [animaDir + "animaBMDistortionCorrection", "-f", tmpDWIImagePrefix + "_B0.nrrd", \
-                                                   "-b", tmpDWIImagePrefix + "_B0_Reverse.nrrd", "-o",
-                                                   tmpDWIImagePrefix + "_B0_corrected.nrrd", "-i",
-                                                   tmpDWIImagePrefix + "_init_correction_tr.nrrd", \
+                                                     "-f", tmpDWIImagePrefix + "_B0" + tmpExtension, "-b", tmpDWIImagePrefix + "_B0_Reverse" + tmpExtension,
+                                                     "-o", tmpDWIImagePrefix + "_init_correction_tr" + tmpExtension]
+        anima_pipeline.add_stage(stages, "init_distortion_correction", initCorrectionCommand,
+                                 [tmpDWIImagePrefix + "_B0" + tmpExtension, tmpDWIImagePrefix + "_B0_Reverse" + tmpExtension],
+                                 [tmpDWIImagePrefix + "_init_correction_tr" + tmpExtension])
+        bmCorrectionCommand = [animaDir + "animaBMDistortionCorrection", "-f", tmpDWIImagePrefix + "_B0" + tmpExtension, \
+                                                   "-b", tmpDWIImagePrefix + "_B0_Reverse" + tmpExtension, "-o",
+                                                   tmpDWIImagePrefix + "_B0_corrected" + tmpExtension, "-i",
+                                                   tmpDWIImagePrefix + "_init_correction_tr" + tmpExtension, \
                                                    "--bs", "3", "-s", "10", "-d", str(args.direction), "-O",
-                                                   tmpDWIImagePrefix + "_B0_correction_tr.nrrd"]
-        call(bmCorrectionCommand)
+                                                   tmpDWIImagePrefix + "_B0_correction_tr" + tmpExtension]
+        anima_pipeline.add_stage(stages, "bm_distortion_correction", bmCorrectionCommand,
+                                 [tmpDWIImagePrefix + "_B0" + tmpExtension, tmpDWIImagePrefix + "_B0_Reverse" + tmpExtension, tmpDWIImagePrefix + "_init_correction_tr" + tmpExtension],
+                                 [tmpDWIImagePrefix + "_B0_corrected" + tmpExtension, tmpDWIImagePrefix + "_B0_correction_tr" + tmpExtension])
 
         applyCorrectionCommand = [animaDir + "animaApplyDistortionCorrection", "-f", outputImage, "-t", \
-                                                      tmpDWIImagePrefix + "_B0_correction_tr.nrrd", "-o",
-                                                      tmpDWIImagePrefix + "_corrected.nrrd"]
-        call(applyCorrectionCommand)
+                                                      tmpDWIImagePrefix + "_B0_correction_tr" + tmpExtension, "-o",
+                                                      tmpDWIImagePrefix + "_corrected" + tmpExtension]
+        anima_pipeline.add_stage(stages, "apply_distortion_correction", applyCorrectionCommand,
+                                 [outputImage, tmpDWIImagePrefix + "_B0_correction_tr" + tmpExtension], [tmpDWIImagePrefix + "_corrected" + tmpExtension])
 
-        outputImage = tmpDWIImagePrefix + "_corrected.nrrd"
+        outputImage = tmpDWIImagePrefix + "_corrected" + tmpExtension
     elif not (args.t1 == ""):
         # diffusion en 4D mais on sait pas recaler 
         # prend b0 de diffusion qui est le 1er volume
         # on le recale au T13D 
         b0ExtractCommand = [animaDir + "animaCropImage", "-i", outputImage, "-t", "0", "-T", "0", "-o",
-                            tmpDWIImagePrefix + "_B0.nrrd"]
-        call(b0ExtractCommand)
+                            tmpDWIImagePrefix + "_B0" + tmpExtension]
+        anima_pipeline.add_stage(stages, "b0_extraction", b0ExtractCommand, [outputImage], [tmpDWIImagePrefix + "_B0" + tmpExtension], threads=1)
 
         T1Prefix = os.path.splitext(args.t1)[0]
         if os.path.splitext(args.t1)[1] == '.gz':
@@ -233,53 +222,60 @@ if args.no_disto_correction is False:
         # moving (T1) vers ref (b0)
         # rigid: rotation + translation
         # le b0 bouge 
-        correctionCommand = [animaDir + "animaPyramidalBMRegistration", "-r", tmpDWIImagePrefix + "_B0.nrrd", \
-                     "-m", T1Prefix + "_masked.nii.gz", "-o", T1Prefix + "_dwi.nrrd","-O", T1Prefix + "_rig_tr.txt"]
-        if args.register_t1_on_dwi is True:
-            correctionCommand += ["-I", "1"]
-        else:
-            correctionCommand += ["-I", "0"]
-        call(correctionCommand)
+        correctionCommand = [animaDir + "animaPyramidalBMRegistration", "-r", tmpDWIImagePrefix + "_B0" + tmpExtension, \
+                     "-m", T1Prefix + "_masked" + maskExtension, "-o", T1Prefix + "_dwi.nrrd","-O", T1Prefix + "_rig_tr.txt"]
+        correctionCommand += t1InitArgs
+        anima_pipeline.add_stage(stages, "t1_to_b0_registration", correctionCommand,
+                                 [tmpDWIImagePrefix + "_B0" + tmpExtension, T1Prefix + "_masked" + maskExtension], [T1Prefix + "_dwi.nrrd", T1Prefix + "_rig_tr.txt"])
 
         correctionCommand = [animaDir + "animaDenseSVFBMRegistration", "-r", T1Prefix + "_dwi.nrrd", \
-                     "-m", tmpDWIImagePrefix + "_B0.nrrd", "-o", tmpDWIImagePrefix + "_B0_corrected.nrrd",
+                     "-m", tmpDWIImagePrefix + "_B0" + tmpExtension, "-o", tmpDWIImagePrefix + "_B0_corrected" + tmpExtension,
                      "-O", dwiImagePrefix + "_B0_correction_tr.nrrd", "-t", "3"]
 #        correctionCommand = [animaDir + "animaDenseSVFBMRegistration", "-r", T1Prefix + "_dwi.nrrd", \
 #                     "-m", tmpDWIImagePrefix + "_B0.nrrd", "-o", tmpDWIImagePrefix + "_B0_corrected.nrrd", "-d",
 #                     str(args.direction), \
 #                     "-O", dwiImagePrefix + "_B0_correction_tr.nrrd", "-t", "3"]
 
-        call(correctionCommand)
+        anima_pipeline.add_stage(stages, "b0_to_t1_registration", correctionCommand,
+                                 [T1Prefix + "_dwi.nrrd", tmpDWIImagePrefix + "_B0" + tmpExtension],
+                                 [tmpDWIImagePrefix + "_B0_corrected" + tmpExtension, dwiImagePrefix + "_B0_correction_tr.nrrd"])
 
         applyCorrectionCommand = [animaDir + "animaApplyDistortionCorrection", "-f", outputImage, "-t", \
                           dwiImagePrefix + "_B0_correction_tr.nrrd", "-o",
-                          tmpDWIImagePrefix + "_corrected.nrrd"]
-        call(applyCorrectionCommand)
+                          tmpDWIImagePrefix + "_corrected" + tmpExtension]
+        anima_pipeline.add_stage(stages, "apply_distortion_correction", applyCorrectionCommand,
+                                 [outputImage, dwiImagePrefix + "_B0_correction_tr.nrrd"], [tmpDWIImagePrefix + "_corrected" + tmpExtension])
 
-        outputImage = tmpDWIImagePrefix + "_corrected.nrrd"
+        outputImage = tmpDWIImagePrefix + "_corrected" + tmpExtension
 
 # Then perform denoising
 if args.no_denoising is False:
     denoisingCommand = [animaDir + "animaNLMeansTemporal", "-i", outputImage, "-b", "0.5", "-o",
-                        tmpDWIImagePrefix + "_nlm.nrrd"]
-    call(denoisingCommand)
-    outputImage = tmpDWIImagePrefix + "_nlm.nrrd"
+                        tmpDWIImagePrefix + "_nlm" + tmpExtension]
+    anima_pipeline.add_stage(stages, "denoising", denoisingCommand, [outputImage], [tmpDWIImagePrefix + "_nlm" + tmpExtension])
+    outputImage = tmpDWIImagePrefix + "_nlm" + tmpExtension
 
 # # Finally, brain mask image
 if args.no_brain_masking is False:
     brainImage = args.t1
     b0ExtractCommand = [animaDir + "animaCropImage", "-i", outputImage, "-t", "0", "-T", "0", "-o",
-                        tmpDWIImagePrefix + "_forBrainExtract.nrrd"]
-    call(b0ExtractCommand)
+                        tmpDWIImagePrefix + "_forBrainExtract" + tmpExtension]
+    anima_pipeline.add_stage(stages, "b0_extraction_for_brain_masking", b0ExtractCommand, [outputImage],
+                             [tmpDWIImagePrefix + "_forBrainExtract" + tmpExtension], threads=1)
 
     if brainImage == "":
-        brainImage = tmpDWIImagePrefix + "_forBrainExtract.nrrd"
+        brainImage = tmpDWIImagePrefix + "_forBrainExtract" + tmpExtension
+        # the mask is named by the brain extraction script (<image>_brainMask.nrrd), whatever --intermediate-format is
         brainExtractionCommand = ["python", animaScriptsDir + "brain_extraction/animaAtlasBasedBrainExtraction.py",
                                                           brainImage]
-        call(brainExtractionCommand)
+        anima_pipeline.add_stage(stages, "dwi_brain_extraction", brainExtractionCommand, [brainImage],
+                                 [tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd"])
 
     if args.t1 == "":
-        shutil.move(tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd", dwiImagePrefix + "_brainMask.nii.gz")
+        # converted (compressed) rather than moved, so that the brain extraction stays up to date in the checkpoint
+        command = [animaDir + "animaConvertImage", "-i", tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd", "-o", dwiImagePrefix + "_brainMask" + maskExtension]
+        anima_pipeline.add_stage(stages, "brain_mask", command, [tmpDWIImagePrefix + "_forBrainExtract_brainMask.nrrd"],
+                                 [dwiImagePrefix + "_brainMask" + maskExtension], threads=1)
     else:
         T1Prefix = os.path.splitext(args.t1)[0]
         if os.path.splitext(args.t1)[1] == '.gz':
@@ -288,50 +284,60 @@ if args.no_brain_masking is False:
         tmpT1Prefix = os.path.join(tmpFolder, os.path.basename(T1Prefix))
 
         t1RegistrationCommand = [animaDir + "animaPyramidalBMRegistration", "-r",
-                                 tmpDWIImagePrefix + "_forBrainExtract.nrrd", "-m", T1Prefix + "_masked.nii.gz", "-o",
+                                 tmpDWIImagePrefix + "_forBrainExtract" + tmpExtension, "-m", T1Prefix + "_masked" + maskExtension, "-o",
                                  T1Prefix + "_rig.nrrd", "-O", T1Prefix + "_rig_tr.txt"]
         
-        if args.register_t1_on_dwi is True:
-            t1RegistrationCommand += ["-I", "1"]
-        else:
-            t1RegistrationCommand += ["-I", "0"]
+        t1RegistrationCommand += t1InitArgs
 
-        call(t1RegistrationCommand)
+        anima_pipeline.add_stage(stages, "t1_registration", t1RegistrationCommand,
+                                 [tmpDWIImagePrefix + "_forBrainExtract" + tmpExtension, T1Prefix + "_masked" + maskExtension], [T1Prefix + "_rig.nrrd", T1Prefix + "_rig_tr.txt"])
         
         command = [animaDir + "animaTransformSerieXmlGenerator", "-i", T1Prefix + "_rig_tr.txt", "-o",
                                             T1Prefix + "_rig_tr.xml"]
-        call(command)
-
-        command = [animaDir + "animaApplyTransformSerie", "-i", T1Prefix + "_brainMask.nii.gz", "-t",
-                                                T1Prefix + "_rig_tr.xml", "-o", dwiImagePrefix + "_brainMask.nii.gz", "-g",
-                                                tmpDWIImagePrefix + "_forBrainExtract.nrrd", "-n", "nearest"]
-        call(command)
-        brainExtractionCommand = [animaDir + "animaMaskImage", "-i", outputImage, "-m", dwiImagePrefix + "_brainMask.nii.gz", \
-                                                                            "-o", tmpDWIImagePrefix + "_masked.nii.gz"]
-        call(brainExtractionCommand)
-        outputImage = tmpDWIImagePrefix + "_masked.nii.gz"
-        shutil.copy(outputImage, dwiImagePrefix + "_preprocessed.nii.gz")
-        shutil.copy(outputBVec, dwiImagePrefix + "_preprocessed.bvec")
+        anima_pipeline.add_stage(stages, "t1_transform", command, [T1Prefix + "_rig_tr.txt"], [T1Prefix + "_rig_tr.xml"], threads=1)
+
+        command = [animaDir + "animaApplyTransformSerie", "-i", T1Prefix + "_brainMask" + maskExtension, "-t",
+                                                T1Prefix + "_rig_tr.xml", "-o", dwiImagePrefix + "_brainMask" + maskExtension, "-g",
+                                                tmpDWIImagePrefix + "_forBrainExtract" + tmpExtension, "-n", "nearest"]
+        anima_pipeline.add_stage(stages, "brain_mask", command,
+                                 [T1Prefix + "_brainMask" + maskExtension, T1Prefix + "_rig_tr.xml", tmpDWIImagePrefix + "_forBrainExtract" + tmpExtension],
+                                 [dwiImagePrefix + "_brainMask" + maskExtension])
+        brainExtractionCommand = [animaDir + "animaMaskImage", "-i", outputImage, "-m", dwiImagePrefix + "_brainMask" + maskExtension, \
+                                                                            "-o", tmpDWIImagePrefix + "_masked" + tmpExtension]
+        anima_pipeline.add_stage(stages, "dwi_masking", brainExtractionCommand, [outputImage, dwiImagePrefix + "_brainMask" + maskExtension],
+                                 [tmpDWIImagePrefix + "_masked" + tmpExtension])
+        outputImage = tmpDWIImagePrefix + "_masked" + tmpExtension
+        # the intermediate image is uncompressed, the final one is compressed
+        command = [animaDir + "animaConvertImage", "-i", outputImage, "-o", dwiImagePrefix + "_preprocessed.nii.gz"]
+        anima_pipeline.add_stage(stages, "preprocessed_image", command, [outputImage], [dwiImagePrefix + "_preprocessed.nii.gz"], threads=1)
+        anima_pipeline.add_stage(stages, "preprocessed_gradients", functools.partial(shutil.copy, outputBVec, dwiImagePrefix + "_preprocessed.bvec"),
+                                 [outputBVec], [dwiImagePrefix + "_preprocessed.bvec"], threads=1)
 
 # Estimate tensors if files were provided
 dtiEstimationCommand = [animaDir + "animaDTIEstimator", "-i", outputImage, "-o", dwiImagePrefix + "_Tensors.nii.gz", \
                         "-O", dwiImagePrefix + "_Tensors_B0.nrrd", "-N", dwiImagePrefix + "_Tensors_NoiseVariance.nrrd", \
                         "-g", outputBVec, "-b", args.bval]
+dtiEstimationInputs = [outputImage, outputBVec, args.bval]
 
 if args.no_brain_masking is False:
-    dtiEstimationCommand += ["-m", dwiImagePrefix + "_brainMask.nii.gz"]
+    dtiEstimationCommand += ["-m", dwiImagePrefix + "_brainMask" + maskExtension]
+    dtiEstimationInputs += [dwiImagePrefix + "_brainMask" + maskExtension]
 
-call(dtiEstimationCommand)
+anima_pipeline.add_stage(stages, "dti_estimation", dtiEstimationCommand, dtiEstimationInputs,
+                         [dwiImagePrefix + "_Tensors.nii.gz", dwiImagePrefix + "_Tensors_B0.nrrd", dwiImagePrefix + "_Tensors_NoiseVariance.nrrd"])
 
-print(".............Compute tractography")
 DTITractography = [animaDir + "animaDTITractography", "--max-length", "300" ,"--min-length", "10","--nb-fibers", "2",\
-                   "-o", dwiImagePrefix + "_fiber_Tensor.vtk","-s", dwiImagePrefix + "_brainMask.nii.gz","-i", dwiImagePrefix + "_Tensors.nii.gz"]
-call(DTITractography)
+                   "-o", dwiImagePrefix + "_fiber_Tensor.vtk","-s", dwiImagePrefix + "_brainMask" + maskExtension,"-i", dwiImagePrefix + "_Tensors.nii.gz"]
+anima_pipeline.add_stage(stages, "tractography", DTITractography, [dwiImagePrefix + "_Tensors.nii.gz", dwiImagePrefix + "_brainMask" + maskExtension],
+                         [dwiImagePrefix + "_fiber_Tensor.vtk"])
 
-
-print(".............Compute DTI scalar")
 DTIScalarMapsCommand=[animaDir +"animaDTIScalarMaps", "-r" ,dwiImagePrefix + "_RD.nii.gz", "-i",dwiImagePrefix + "_Tensors.nii.gz", "-x", dwiImagePrefix + "_AD.nii.gz", "-f", dwiImagePrefix + "_FA.nii.gz", "-a", dwiImagePrefix + "_ADC.nii.gz"]
-call(DTIScalarMapsCommand)
+anima_pipeline.add_stage(stages, "scalar_maps", DTIScalarMapsCommand, [dwiImagePrefix + "_Tensors.nii.gz"],
+                         [dwiImagePrefix + "_RD.nii.gz", dwiImagePrefix + "_AD.nii.gz", dwiImagePrefix + "_FA.nii.gz", dwiImagePrefix + "_ADC.nii.gz"])
+
+with anima_pipeline.scratch_folder(tmpFolder, args.remove_scratch_on_failure and not args.keep_scratch_on_failure):
+    # wall time, CPU time, peak memory and output size of each stage
+    anima_pipeline.run_stages(checkpoint, stages, args.cpu_budget, tmpFolder, dwiImagePrefix + "_timings")
 
 #T1Prefix = os.path.splitext(args.t1)[0]
 #if os.path.splitext(args.t1)[1] == '.gz':
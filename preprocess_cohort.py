@@ -0,0 +1,168 @@
+import os
+import sys
+import csv
+import json
+import glob
+import time
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from anima_pipeline import REPORT_COLUMNS
+
+#
+# Script to run the diffusion preprocessing (modifiedAnimaDiffusionImagePreprocessing_Sebastien_flip.py)
+# on every subject of the data folder converted by extract_nifti_from_dicom.py:
+# data/<subject>/<bidsDir>/dwi_<subject>.nii.gz, encoding_<subject>.bval and the dicom folder.
+#
+# Subjects are processed in parallel with --jobs N, each one by its own preprocessing process,
+# and the CPUs of --cpu-budget are shared between them (the --cpu-budget of each subject is
+# cpu-budget / jobs), so that the Anima tools of the subjects do not oversubscribe the node.
+# The output of each subject is written to data/<subject>/<bidsDir>/preprocess.log.
+#
+# Arguments after -- are given to the preprocessing script of every subject, e.g.
+# python preprocess_cohort.py diffusion -j 4 -- --no-denoising 1
+#
+# A summary of the cohort (status of each subject, and wall time, CPU time, peak memory and output
+# size of each of its stages, read from the timing report of the subject) is written to
+# data/cohort_summary_<bidsDir>.json and .csv, and the median (p50) and 95th percentile (p95) of
+# each stage over the subjects are printed. With --report, the summary is made from the reports of
+# the previous runs, without running the preprocessing.
+#
+
+dataFolder = 'data'
+
+preprocessingScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'modifiedAnimaDiffusionImagePreprocessing_Sebastien_flip.py')
+
+# the file of folder matching pattern, None if there is not exactly one
+def single_file(folder, pattern):
+    files = glob.glob(os.path.join(folder, pattern))
+    return files[0] if len(files) == 1 else None
+
+# DWI image, b-values and dicom folder of each subject having the three of them
+def discover_subjects(bidsDir):
+    subjects = {}
+    for filename in sorted(os.listdir(dataFolder)):
+        folder = os.path.join(dataFolder, filename, bidsDir)
+        if not os.path.isdir(folder):
+            continue
+        dwi = single_file(folder, 'dwi_*.nii.gz')
+        bval = single_file(folder, 'encoding_*.bval')
+        dicom = os.path.join(folder, 'dicom')
+        if dwi is None or bval is None or not os.path.isdir(dicom):
+            print(filename, 'skipped: no single dwi_*.nii.gz and encoding_*.bval with a dicom folder in', folder)
+            continue
+        subjects[filename] = { 'dwi': dwi, 'bval': bval, 'dicom': dicom }
+    return subjects
+
+def dwi_prefix(dwi):
+    return dwi[:-len('.nii.gz')]
+
+def preprocessing_command(subject, cpuBudget, extraArgs):
+    return [sys.executable, preprocessingScript, '-i', subject['dwi'], '-b', subject['bval'], '-D', subject['dicom'],
+            '--cpu-budget', str(cpuBudget)] + extraArgs
+
+# run the preprocessing of one subject, returns its return code and wall time
+def preprocess_subject(filename, subject, bidsDir, cpuBudget, extraArgs):
+    start = time.perf_counter()
+    with open(os.path.join(dataFolder, filename, bidsDir, 'preprocess.log'), 'w') as log:
+        returncode = subprocess.run(preprocessing_command(subject, cpuBudget, extraArgs), stdout=log, stderr=subprocess.STDOUT).returncode
+    return returncode, time.perf_counter() - start
+
+# status and resource usage of the stages of the subject, from its timing report
+def subject_stages(subject):
+    path = dwi_prefix(subject['dwi']) + '_timings.json'
+    if not os.path.exists(path):
+        return {}
+    with open(path) as file:
+        return json.load(file)
+
+def write_summary(bidsDir, summary):
+    path = os.path.join(dataFolder, 'cohort_summary_' + bidsDir)
+    with open(path + '.json', 'w') as file:
+        json.dump(summary, file, indent=1, sort_keys=True)
+    with open(path + '.csv', 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['subject', 'subject_status'] + REPORT_COLUMNS)
+        for filename, result in sorted(summary.items()):
+            for stage, record in result['stages'].items():
+                writer.writerow([filename, result['status'], stage] + [record.get(key, '') for key in REPORT_COLUMNS[1:]])
+    return path
+
+# preprocess the subjects, jobs at a time, returns the summary of the cohort
+def preprocess_subjects(subjects, bidsDir, jobs, cpuBudget, extraArgs):
+    cpuBudget = max(1, cpuBudget // jobs)
+    print(str(len(subjects)) + ' subjects to preprocess, ' + str(jobs) + ' at a time with ' + str(cpuBudget) + ' CPUs each')
+
+    # a failed subject is reported at the end instead of stopping the other subjects
+    summary = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = { executor.submit(preprocess_subject, filename, subject, bidsDir, cpuBudget, extraArgs): filename for filename, subject in subjects.items() }
+        for future in as_completed(futures):
+            filename = futures[future]
+            returncode, seconds = future.result()
+            summary[filename] = { 'status': 'done' if returncode == 0 else 'failed', 'returncode': returncode,
+                                  'seconds': round(seconds, 3), 'stages': subject_stages(subjects[filename]) }
+            print(filename, summary[filename]['status'], 'in', format(seconds, '.1f'), 's')
+    return summary
+
+# summary of the cohort from the timing reports of the previous runs
+def report_summary(subjects):
+    summary = {}
+    for filename, subject in subjects.items():
+        stages = subject_stages(subject)
+        if len(stages) > 0:
+            failed = any(record['status'] in ['failed', 'not run'] for record in stages.values())
+            summary[filename] = { 'status': 'failed' if failed else 'done', 'stages': stages }
+    return summary
+
+# linear interpolation between the closest ranks, as numpy.percentile
+def percentile(values, q):
+    values = sorted(values)
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+# p50 and p95 of the wall time, CPU time and peak memory of each stage over the subjects, slowest stages first
+def print_stage_percentiles(summary):
+    values = {}
+    for result in summary.values():
+        for stage, record in result['stages'].items():
+            if 'seconds' in record:
+                values.setdefault(stage, []).append(record)
+    print('  ' + 'stage'.ljust(36) + 'subjects   wall p50   wall p95    cpu p50    cpu p95  rss p50 (MB)  rss p95 (MB)')
+    for stage, records in sorted(values.items(), key=lambda item: -percentile([record['seconds'] for record in item[1]], 50)):
+        line = '  ' + stage.ljust(36) + str(len(records)).rjust(8)
+        for key, width in [('seconds', 11), ('cpu_seconds', 11), ('max_rss_mb', 14)]:
+            measures = [record[key] for record in records if key in record]
+            for q in [50, 95]:
+                line += (format(percentile(measures, q), '.1f') if len(measures) > 0 else '-').rjust(width)
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the diffusion preprocessing on every subject of the data folder.')
+    parser.add_argument('bidsDir', nargs='?', default='diffusion', help='Subdirectory of the subjects containing the diffusion sequence.')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of subjects processed in parallel.')
+    parser.add_argument('--cpu-budget', type=int, default=os.cpu_count(), help='Number of CPUs shared by the subjects processed in parallel.')
+    parser.add_argument('--report', action='store_true', help='Only summarize the timing reports of the previous runs of the subjects.')
+    # the arguments after -- are not parsed, they are given to the preprocessing script
+    argv = sys.argv[1:]
+    extraArgs = argv[argv.index('--') + 1:] if '--' in argv else []
+    args = parser.parse_args(argv[:argv.index('--')] if '--' in argv else argv)
+
+    subjects = discover_subjects(args.bidsDir)
+    if args.report:
+        summary = report_summary(subjects)
+        print(str(len(summary)) + '/' + str(len(subjects)) + ' subjects with a timing report')
+    else:
+        summary = preprocess_subjects(subjects, args.bidsDir, args.jobs, args.cpu_budget, extraArgs)
+
+    path = write_summary(args.bidsDir, summary)
+    print('Resource usage per stage (summary in ' + path + '.json and .csv):')
+    print_stage_percentiles(summary)
+
+    failures = sorted(filename for filename, result in summary.items() if result['status'] == 'failed')
+    if len(failures) > 0:
+        print('Failed subjects (see data/<subject>/' + args.bidsDir + '/preprocess.log): ' + ', '.join(failures))
+        sys.exit(1)
@@ -2,14 +2,23 @@ import requests
 import json
 import getpass
 import re
+import os
 import sys
+import time
+import shutil
+import sqlite3
+import zipfile
 from pathlib import Path
 Path.ls = lambda x: list(x.iterdir())
 from http.client import responses
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import argparse
 import logging
+import threading
 import http.client as http_client
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 def create_arg_parser():
     parser = argparse.ArgumentParser(prog=__file__, description="""Shanoir downloader""", formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -34,6 +43,14 @@ def add_arguments(parser):
     parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Print log messages.')
     parser.add_argument('-t', '--timeout', type=float, default=60, help='The request timeout.')
     parser.add_argument('-lf', '--log_file', type=str, help="Path to the log file", default='downloads.log')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of datasets to download in parallel.')
+    parser.add_argument('-cs', '--chunk_size', type=float, default=0, help='Size in MiB of the chunks read from the network while downloading (0: chosen from the size of the archive).')
+    parser.add_argument('-rb', '--reuse_buffer', default=False, action='store_true', help='Read the downloads into one preallocated buffer instead of allocating a new chunk for each read.')
+    parser.add_argument('-bs', '--batch_size', type=int, default=0, help='Download the search results with the massiveDownload endpoint, by batches of at most this number of datasets (0: one request per dataset).')
+    parser.add_argument('-ct', '--cache_ttl', type=float, default=0, help='Number of hours during which search results and dataset lookups are read from the local cache (0: no cache, new datasets are always seen).')
+    parser.add_argument('-cm', '--cache_max_entries', type=int, default=10000, help='Maximum number of entries in the local cache, the least recently used ones are evicted.')
+    parser.add_argument('-rf', '--refresh', default=False, action='store_true', help='Ignore the cached search results and dataset lookups (the cache is updated with the new responses).')
+    parser.add_argument('-rt', '--retries', type=int, default=3, help='Number of retries on server errors (5xx) and connection resets.')
 
     return parser
 
@@ -59,6 +76,26 @@ def init_logging(args):
         requests_log.propagate = True
 
 
+# a single session keeps the connections to the server (and the proxy) alive between requests
+def create_session(args):
+    retry = Retry(
+        total=args.retries,
+        connect=args.retries,
+        read=args.retries,
+        status=args.retries,
+        backoff_factor=0.5,
+        status_forcelist=[500, 502, 503, 504],
+        allowed_methods=None, # also retry POST requests (solr search, massive download)
+        raise_on_status=False,
+    )
+    # one connection per worker, plus one for the token requests
+    pool_size = max(getattr(args, 'workers', 1), 1) + 1
+    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 def initialize(args):
     init_logging(args)
 
@@ -120,11 +157,101 @@ def initialize(args):
             # 'https': 'https://' + proxy_url,
         }
     
-    return { 'domain': server_domain, 'username': username, 'verify': verify, 'proxies': proxies, 'output_folder': output_folder, 'timeout': args.timeout }
-
+    session = create_session(args)
+
+    chunk_size = int(args.chunk_size * MiB)
+
+    cache = None
+    if args.cache_ttl > 0:
+        cache = open_cache(output_folder / '.shanoir_cache.sqlite', args.cache_ttl * 3600, args.cache_max_entries, args.refresh)
+
+    return { 'domain': server_domain, 'username': username, 'verify': verify, 'proxies': proxies, 'output_folder': output_folder, 'timeout': args.timeout, 'session': session,
+             'chunk_size': chunk_size, 'reuse_buffer': args.reuse_buffer, 'cache': cache }
+
+# the cache stores the json responses of the metadata requests (search, dataset lookups) in a SQLite database,
+# keyed by the request and its parameters
+def open_cache(path, ttl, max_entries, refresh=False):
+    connection = sqlite3.connect(str(path), check_same_thread=False)
+    connection.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)')
+    connection.commit()
+    return { 'connection': connection, 'lock': threading.Lock(), 'ttl': ttl, 'max_entries': max_entries, 'refresh': refresh }
+
+def cache_get(cache, key):
+    if cache is None or cache['refresh']:
+        return None
+    now = time.time()
+    with cache['lock']:
+        row = cache['connection'].execute('SELECT value FROM responses WHERE key = ? AND created > ?', (key, now - cache['ttl'])).fetchone()
+        if row is None:
+            return None
+        cache['connection'].execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+        cache['connection'].commit()
+    return json.loads(row[0])
+
+def cache_put(cache, key, value):
+    if cache is None:
+        return
+    now = time.time()
+    with cache['lock']:
+        connection = cache['connection']
+        connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)', (key, json.dumps(value), now, now))
+        connection.execute('DELETE FROM responses WHERE created <= ?', (now - cache['ttl'],))
+        # evict the least recently used entries above max_entries
+        connection.execute('DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)', (cache['max_entries'],))
+        connection.commit()
+
+# return the cached json for the request described by key_parts, or call fetch and cache its result (unless it is None)
+def cached_json(config, key_parts, fetch):
+    cache = config.get('cache')
+    key = json.dumps([config['domain']] + key_parts, sort_keys=True)
+    value = cache_get(cache, key)
+    if value is None:
+        value = fetch()
+        if value is not None:
+            cache_put(cache, key, value)
+    return value
+
+# the session created by initialize, or the requests module itself (one connection per call) if there is none
+def get_session(config):
+    return config.get('session') or requests
+
+
+# Keycloak tokens, shared by every thread (download workers, search prefetch, background refresh) and protected by token_lock;
+# the access token is refreshed in the background TOKEN_REFRESH_MARGIN seconds before it expires
+token = { 'access_token': None, 'refresh_token': None, 'expires_at': 0, 'refresh_margin': 0, 'timer': None }
+token_lock = threading.RLock()
+TOKEN_REFRESH_MARGIN = 60
+
+# store the tokens of a Keycloak response and schedule the next refresh
+def set_token(config, response_json):
+    with token_lock:
+        expires_in = float(response_json.get('expires_in', 300))
+        token['access_token'] = response_json['access_token']
+        token['refresh_token'] = response_json.get('refresh_token', token['refresh_token'])
+        token['expires_at'] = time.monotonic() + expires_in
+        # at most half of the lifetime of short-lived tokens
+        token['refresh_margin'] = min(TOKEN_REFRESH_MARGIN, expires_in / 2)
+        if token['timer'] is not None:
+            token['timer'].cancel()
+        token['timer'] = threading.Timer(max(expires_in - token['refresh_margin'], 1), refresh_token_in_background, args=(config,))
+        token['timer'].daemon = True
+        token['timer'].start()
+
+def refresh_token_in_background(config):
+    try:
+        with token_lock:
+            refresh_access_token(config)
+    except Exception as e:
+        logging.error('Could not refresh the access token: ' + str(e))
 
-access_token = None
-refresh_token = None
+# return a valid access token, asks for one if there is none yet and refreshes it if the background refresh did not happen in time
+def get_access_token(config):
+    with token_lock:
+        if token['access_token'] is None:
+            ask_access_token(config)
+        elif time.monotonic() > token['expires_at'] - token['refresh_margin'] / 2:
+            refresh_access_token(config)
+        return token['access_token']
 
 # using user's password, get the first access token and the refresh token
 def ask_access_token(config):
@@ -144,7 +271,7 @@ def ask_access_token(config):
 
     headers = {'content-type': 'application/x-www-form-urlencoded'}
     print('get keycloak token...', end=' ')
-    response = requests.post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
+    response = get_session(config).post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
     if not hasattr(response, 'status_code') or response.status_code != 200:
         print('Failed to connect, make sur you have a certified IP or are connected on a valid VPN.')
         exit(1)
@@ -153,8 +280,7 @@ def ask_access_token(config):
     if 'error_description' in response_json and response_json['error_description'] == 'Invalid user credentials':
         print('bad username or password')
         exit(1)
-    global refresh_token 
-    refresh_token = response_json['refresh_token']
+    set_token(config, response_json)
     return response_json['access_token']
 
 def get_filename_from_response(output_folder, response):
@@ -168,73 +294,161 @@ def get_filename_from_response(output_folder, response):
 
 try:
     from tqdm import tqdm
-
-    def download_file(output_folder, response):
-        filename = get_filename_from_response(output_folder, response)
-        if not filename: return
-        total = int(response.headers.get('content-length', 0))
-        with open(filename, 'wb') as file, tqdm(
-            desc=filename,
-            total=total,
-            unit='iB',
-            unit_scale=True,
-            unit_divisor=1024,
-        ) as bar:
-            for data in response.iter_content(chunk_size=1024):
-                size = file.write(data)
-                bar.update(size)
-
 except ImportError as e:
-
-    def download_file(output_folder, response):
-        filename = get_filename_from_response(output_folder, response)
-        if not filename: return
-        open(filename, 'wb').write(response.content)
-        return
+    tqdm = None
+
+MiB = 1024 * 1024
+# bounds of the chunk size chosen from the archive size, and minimum delay between two progress bar updates
+MIN_CHUNK_SIZE = 1 * MiB
+MAX_CHUNK_SIZE = 16 * MiB
+PROGRESS_INTERVAL = 0.5
+
+# aim at about a hundred reads per archive, within [MIN_CHUNK_SIZE, MAX_CHUNK_SIZE]
+def get_chunk_size(total, chunk_size=0):
+    if chunk_size and chunk_size > 0:
+        return chunk_size
+    return min(max(total // 100, MIN_CHUNK_SIZE), MAX_CHUNK_SIZE)
+
+# read the response body into a single preallocated buffer, returns None when the body has to be decoded;
+# the connection is released to the pool of the session once the body is read
+def iter_response_into(response, chunk_size):
+    if 'content-encoding' in response.headers:
+        return None
+    # read from the underlying http.client response: the readinto of urllib3 reads into a new bytes object and
+    # copies it, the body is not encoded so that nothing is skipped by bypassing urllib3
+    raw = getattr(response.raw, '_fp', None)
+    if raw is None or not hasattr(raw, 'readinto'):
+        return None
+    def iterate():
+        buffer = memoryview(bytearray(chunk_size))
+        while True:
+            size = raw.readinto(buffer)
+            if not size:
+                break
+            yield buffer[:size]
+        response.raw.release_conn()
+    return iterate()
+
+# stream the response body into file, updating the progress bar at most every PROGRESS_INTERVAL seconds
+def write_response(file, response, total, chunk_size=0, reuse_buffer=False, bar=None):
+    chunk_size = get_chunk_size(total, chunk_size)
+    chunks = iter_response_into(response, chunk_size) if reuse_buffer else None
+    if chunks is None:
+        chunks = response.iter_content(chunk_size=chunk_size)
+    pending = 0
+    last_update = time.monotonic()
+    try:
+        for data in chunks:
+            pending += file.write(data)
+            if bar and time.monotonic() - last_update >= PROGRESS_INTERVAL:
+                bar.update(pending)
+                pending = 0
+                last_update = time.monotonic()
+    finally:
+        # a body read completely leaves the connection in the pool, an interrupted one closes it
+        response.close()
+    if bar: bar.update(pending)
+
+# the archive is written to filename.part and renamed once complete, so that an interrupted download
+# never leaves a truncated archive under its final name;
+# request_range(offset) must perform the same request from the given byte offset (HTTP Range) to resume a previous .part file.
+# The response is streamed: only its headers are read before an existing archive is skipped.
+# With skip_existing False, an existing archive or .part file is always replaced (e.g. massiveDownload archives, whose
+# name does not depend on the requested datasets)
+def download_file(output_folder, response, progress=True, request_range=None, chunk_size=0, reuse_buffer=False, skip_existing=True):
+    filename = get_filename_from_response(output_folder, response)
+    if not filename: return
+    # content-length is the size on the wire, it only matches the file size if the body is not encoded
+    total = int(response.headers.get('content-length', 0)) if 'content-encoding' not in response.headers else 0
+
+    # an existing archive is only complete if its size is known and matches, otherwise it is downloaded again
+    if skip_existing and total > 0 and os.path.exists(filename) and os.path.getsize(filename) == total:
+        print('Skipping', filename, '(already downloaded)')
+        response.close()
+        return filename
+
+    part_filename = filename + '.part'
+    offset = os.path.getsize(part_filename) if skip_existing and os.path.exists(part_filename) else 0
+    mode = 'wb'
+
+    if offset > 0 and total > 0 and offset < total and request_range is not None:
+        response.close()
+        response = request_range(offset)
+        content_range = response.headers.get('content-range', '')
+        if response.status_code == 206 and content_range.startswith('bytes ' + str(offset) + '-'):
+            print('Resuming', filename, 'from byte', offset)
+            mode = 'ab'
+        else:
+            # the server ignored the range, start over with the full body it sent
+            offset = 0
+    elif offset == total and total > 0:
+        response.close()
+        mode = None
+    else:
+        offset = 0
+
+    if mode is not None:
+        bar = tqdm(desc=filename, total=total, initial=offset, unit='iB', unit_scale=True, unit_divisor=1024, disable=not progress) if tqdm else None
+        with open(part_filename, mode) as file:
+            write_response(file, response, total - offset, chunk_size, reuse_buffer, bar)
+        if bar: bar.close()
+
+    size = os.path.getsize(part_filename)
+    if total > 0 and size != total:
+        raise Exception('Incomplete download of ' + filename + ': ' + str(size) + ' bytes written out of ' + str(total) + ', run again to resume')
+    os.replace(part_filename, filename)
+    return filename
 
 # get a new acess token using the refresh token
 def refresh_access_token(config):
     url = 'https://' + config['domain'] + '/auth/realms/shanoir-ng/protocol/openid-connect/token'
     payload = {
         'grant_type' : 'refresh_token',
-        'refresh_token' : refresh_token,
+        'refresh_token' : token['refresh_token'],
         'client_id' : 'shanoir-uploader'
     }
     headers = {'content-type': 'application/x-www-form-urlencoded'}
     print('refresh keycloak token...')
-    response = requests.post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
+    response = get_session(config).post(url, data=payload, headers=headers, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'])
     if response.status_code != 200:
-        logging.error(f'response status : {response.status_code}, {responses[response.status_code]}')
+        logging.error(f'response status : {response.status_code}, {responses.get(response.status_code, response.reason)}')
+        raise Exception('Could not refresh the access token, response status: ' + str(response.status_code) + ' ' + str(response.reason))
     response_json = response.json()
+    set_token(config, response_json)
     return response_json['access_token']
 
 def perform_rest_request(config, rtype, url, **kwargs):
     response = None
+    session = get_session(config)
     
     if rtype == 'get':
-        response = requests.get(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
+        response = session.get(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
     elif rtype == 'post':
-        response = requests.post(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
+        response = session.post(url, proxies=config['proxies'], verify=config['verify'], timeout=config['timeout'], **kwargs)
     else:
         print('Error: unimplemented request type')
 
     return response
 
 
-# perform a request on the given url, asks for a new access token if the current one is outdated
-def rest_request(config, rtype, url, raise_for_status=True, **kwargs):
-    global access_token
-    if access_token is None:
-        access_token = ask_access_token(config)
+# perform a request on the given url with a valid access token, see get_access_token
+def rest_request(config, rtype, url, raise_for_status=True, extra_headers=None, **kwargs):
+    used_token = get_access_token(config)
     headers = { 
-        'Authorization' : 'Bearer ' + access_token,
+        'Authorization' : 'Bearer ' + used_token,
         'content-type' : 'application/json'
     }
+    if extra_headers:
+        headers.update(extra_headers)
     response = perform_rest_request(config, rtype, url, headers=headers, **kwargs)
-    # if token is outdated, refresh it and try again
+    # if token is outdated anyway (e.g. revoked), refresh it and try again
     if response.status_code == 401:
-        access_token = refresh_access_token(config)
-        headers['Authorization'] = 'Bearer ' + access_token
+        with token_lock:
+            # another thread may already have refreshed the token in the meantime
+            if token['access_token'] == used_token:
+                refresh_access_token(config)
+            used_token = token['access_token']
+        headers['Authorization'] = 'Bearer ' + used_token
         response = perform_rest_request(config, rtype, url, headers=headers, **kwargs)
     if raise_for_status:
         response.raise_for_status()
@@ -245,8 +459,8 @@ def log_response(response):
     return
 
 # perform a GET request on the given url, asks for a new access token if the current one is outdated
-def rest_get(config, url, params=None, stream=None):
-    return rest_request(config, 'get', url, params=params, stream=stream)
+def rest_get(config, url, params=None, stream=None, headers=None):
+    return rest_request(config, 'get', url, extra_headers=headers, params=params, stream=stream)
 
 # perform a POST request on the given url, asks for a new access token if the current one is outdated
 def rest_post(config, url, params=None, files=None, stream=None, json=None, data=None):
@@ -267,13 +481,15 @@ def rest_post(config, url, params=None, files=None, stream=None, json=None, data
 # filename = re.findall('filename=(.+)', response.headers.get('Content-Disposition'))[0]
 # open(filename, 'wb').write(response.content)
 
-def download_dataset(config, dataset_id, file_format):
+def download_dataset(config, dataset_id, file_format, progress=True):
     print('Downloading dataset', dataset_id)
     file_format = 'nii' if file_format == 'nifti' else 'dcm'
     url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/download/' + str(dataset_id)
-    response = rest_get(config, url, params={ 'format': file_format })
-    download_file(config['output_folder'], response)
-    return
+    params = { 'format': file_format }
+    response = rest_get(config, url, params=params, stream=True)
+    request_range = lambda offset: rest_get(config, url, params=params, stream=True, headers={ 'Range': 'bytes=' + str(offset) + '-' })
+    return download_file(config['output_folder'], response, progress=progress, request_range=request_range,
+                         chunk_size=config.get('chunk_size', 0), reuse_buffer=config.get('reuse_buffer', False))
 
 def download_datasets(config, dataset_ids, file_format):
     print('Downloading datasets', dataset_ids)
@@ -282,28 +498,95 @@ def download_datasets(config, dataset_ids, file_format):
     url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/massiveDownload'
     params = dict(datasetIds=dataset_ids, format=file_format)
     response = rest_post(config, url, params=params, files=params, stream=True)
-    download_file(config['output_folder'], response)
-    return
+    return download_file(config['output_folder'], response, chunk_size=config.get('chunk_size', 0), reuse_buffer=config.get('reuse_buffer', False),
+                         skip_existing=False)
+
+# split an archive returned by massiveDownload into one archive per dataset, named <dataset id>.zip in output_folder;
+# the members of a dataset are the ones whose top-level folder name contains the dataset id,
+# returns a dictionary dataset id -> archive path, the massive archive is removed if every member was assigned.
+# The members are stored without compression: zipfile cannot copy compressed data as is, and deflating them again
+# would cost as much as the download (the archives are extracted by extract_nifti_from_dicom.py)
+def split_massive_archive(archive, output_folder, dataset_ids):
+    dataset_ids = [str(dataset_id) for dataset_id in dataset_ids]
+    patterns = { dataset_id: re.compile(r'(?<!\d)' + re.escape(dataset_id) + r'(?!\d)') for dataset_id in dataset_ids }
+    members = { dataset_id: [] for dataset_id in dataset_ids }
+    unassigned = []
+
+    with zipfile.ZipFile(archive) as massive_zip:
+        for info in massive_zip.infolist():
+            if info.is_dir(): continue
+            folder = info.filename.split('/')[0]
+            matches = [dataset_id for dataset_id, pattern in patterns.items() if pattern.search(folder)]
+            if len(matches) == 1:
+                members[matches[0]].append(info)
+            else:
+                unassigned.append(info.filename)
+
+        filenames = {}
+        for dataset_id, infos in members.items():
+            if len(infos) == 0: continue
+            filename = str(Path(output_folder) / (dataset_id + '.zip'))
+            with zipfile.ZipFile(filename + '.part', 'w', compression=zipfile.ZIP_STORED) as dataset_zip:
+                for info in infos:
+                    # remove the dataset folder so that the archive looks like a single dataset download
+                    name = info.filename.split('/', 1)[1] if '/' in info.filename else info.filename
+                    dataset_info = zipfile.ZipInfo(name, date_time=info.date_time)
+                    dataset_info.file_size = info.file_size # zip64 if needed
+                    with massive_zip.open(info) as source, dataset_zip.open(dataset_info, 'w') as destination:
+                        shutil.copyfileobj(source, destination, MiB)
+            os.replace(filename + '.part', filename)
+            filenames[dataset_id] = filename
+
+    if len(unassigned) > 0:
+        logging.error(f'{len(unassigned)} files of {archive} could not be assigned to a dataset, the archive is kept: {unassigned[:10]}')
+    else:
+        os.remove(archive)
+    return filenames
+
+# download the datasets with the massiveDownload endpoint, batch_size datasets per request,
+# returns a dictionary dataset id -> archive path of the datasets found in the returned archives;
+# errors are logged so that the other batches are still downloaded
+def download_datasets_by_batch(config, dataset_ids, file_format, batch_size):
+    filenames = {}
+    for i in range(0, len(dataset_ids), batch_size):
+        batch = dataset_ids[i:i + batch_size]
+        try:
+            archive = download_datasets(config, batch, file_format)
+            if archive is None:
+                logging.error(f'No archive returned for the datasets {batch}')
+                continue
+            # the server gives the same name to the archives of every batch, an archive kept after the split
+            # (unassigned files) must not be taken for the one of the next batch, nor for a dataset archive
+            batch_archive = str(Path(config['output_folder']) / ('massive_' + str(batch[0]) + '.zip'))
+            os.replace(archive, batch_archive)
+            filenames.update(split_massive_archive(batch_archive, config['output_folder'], batch))
+        except requests.HTTPError as e:
+            error_message = e.response.error if hasattr(e.response, 'error') else ''
+            logging.error(f'Response status code: {e.response.status_code}, reason: {e.response.reason}, error: {error_message}')
+            logging.error(str(e))
+        except requests.ConnectionError as e:
+            logging.error(str(e))
+        except Exception as e:
+            logging.error(str(e))
+    return filenames
 
 def download_dataset_by_study(config, study_id, file_format):
     print('Downloading datasets from study', study_id)
     file_format = 'nii' if file_format == 'nifti' else 'dcm'
     url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/massiveDownloadByStudy'
-    response = rest_get(config, url, params={ 'studyId': study_id, 'format': file_format })
-    download_file(config['output_folder'], response)
+    response = rest_get(config, url, params={ 'studyId': study_id, 'format': file_format }, stream=True)
+    download_file(config['output_folder'], response, chunk_size=config.get('chunk_size', 0), reuse_buffer=config.get('reuse_buffer', False))
     return
 
 def find_dataset_ids_by_subject_id(config, subject_id):
     print('Getting datasets from subject', subject_id)
     url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/subject/' + subject_id
-    response = rest_get(config, url)
-    return response.json()
+    return cached_json(config, [url], lambda: rest_get(config, url).json())
 
 def find_dataset_ids_by_subject_id_study_id(config, subject_id, study_id):
     print('Getting datasets from subject', subject_id, 'and study', study_id)
     url = 'https://' + config['domain'] + '/shanoir-ng/datasets/datasets/subject/' + subject_id + '/study/' + study_id
-    response = rest_get(config, url)
-    return response.json()
+    return cached_json(config, [url], lambda: rest_get(config, url).json())
 
 def download_dataset_by_subject(config, subject_id, file_format):
     dataset_ids = find_dataset_ids_by_subject_id(config, subject_id)
@@ -360,7 +643,8 @@ def download_datasets_from_ids(args):
     return
 
 
-def solr_search(config, args):
+# search one page of results, page defaults to args.page
+def solr_search(config, args, page=None):
 
     # facet = {
     #   "centerName": {},
@@ -402,25 +686,116 @@ def solr_search(config, args):
         'searchText': args.search_text
     }
 
-    params = dict(page=args.page, size=args.size, sort=args.sort)
+    params = dict(page=args.page if page is None else page, size=args.size, sort=args.sort)
     response = rest_post(config, url, params=params, data=json.dumps(data))
 
     return response
-    
-def download_search_results(config, args, response):
-
-    if response.status_code == 200:
-        for item in response.json()['content']:
-            try:
-                download_dataset(config, item['datasetId'], args.format)
-            except requests.HTTPError as e:
-                error_message = e.response.error if hasattr(e.response, 'error') else ''
-                logging.error(f'Response status code: {e.response.status_code}, reason: {e.response.reason}, error: {error_message}')
-                logging.error(str(e))
-            except requests.URLError as e:
-                logging.error(str(e))
-            except Exception as e:
-                logging.error(str(e))    
+
+# items of one page of results and whether it is the last page
+def get_search_page(config, args, page):
+    def fetch():
+        response = solr_search(config, args, page)
+        if response.status_code == 200:
+            return response.json()
+        # 204: no result, the HTTP errors are raised by rest_post
+        if response.status_code != 204:
+            logging.error(f'Error returned by the search request: status of the response = {response.status_code}, reason: {response.reason}')
+        return None
+    response_json = cached_json(config, ['solr', args.search_text, args.expert_mode, int(page), int(args.size), args.sort], fetch)
+    if response_json is None:
+        return [], True
+    items = response_json['content']
+    last = response_json.get('last', len(items) < int(args.size))
+    return items, last or len(items) == 0
+
+# lazily yield the items of every page of the search, starting at args.page;
+# with prefetch, the next page is requested while the caller processes the current one
+def iter_search_pages(config, args, prefetch=False):
+    page = int(args.page)
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    try:
+        next_page = executor.submit(get_search_page, config, args, page) if executor else None
+        while True:
+            items, last = next_page.result() if executor else get_search_page(config, args, page)
+            page += 1
+            if executor and not last:
+                next_page = executor.submit(get_search_page, config, args, page)
+            if len(items) > 0:
+                yield items
+            if last:
+                break
+    finally:
+        if executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+# lazily yield every item of the search, see iter_search_pages
+def iter_search_results(config, args, prefetch=False):
+    for items in iter_search_pages(config, args, prefetch):
+        yield from items
+
+# search the datasets of many subjects with one query per chunk of subjects (combined with OR) instead of one query per subject,
+# search_text is the part of the query common to all subjects (for example 'studyName:LONGIDEP')
+def search_subjects(config, args, search_text, subjects, chunk_size=50):
+    subjects = list(dict.fromkeys(subjects)) # remove duplicates, keep order
+    items = []
+    for i in range(0, len(subjects), chunk_size):
+        chunk = subjects[i:i + chunk_size]
+        chunk_args = argparse.Namespace(**vars(args))
+        chunk_args.search_text = search_text + ' AND subjectName:(' + ' OR '.join(chunk) + ')'
+        print('Searching subjects', i + 1, 'to', i + len(chunk), 'of', len(subjects))
+        items += list(iter_search_results(config, chunk_args, prefetch=True))
+    return items
+
+# download one item of a search result and return the path of the archive,
+# errors are logged (and None is returned) so that the other items are still downloaded
+def download_search_result_item(config, args, item, progress=True):
+    try:
+        return download_dataset(config, item['datasetId'], args.format, progress=progress)
+    except requests.HTTPError as e:
+        error_message = e.response.error if hasattr(e.response, 'error') else ''
+        logging.error(f'Response status code: {e.response.status_code}, reason: {e.response.reason}, error: {error_message}')
+        logging.error(str(e))
+    except requests.ConnectionError as e:
+        logging.error(str(e))
+    except Exception as e:
+        logging.error(str(e))
+    return None
+
+# download the given search items by batches with massiveDownload, returns the paths of the archives in the same order
+def download_search_items_by_batch(config, args, items):
+    dataset_ids = [str(item['datasetId']) for item in items]
+    filenames = download_datasets_by_batch(config, dataset_ids, args.format, args.batch_size)
+    for dataset_id in dataset_ids:
+        if dataset_id not in filenames:
+            logging.error(f'Dataset {dataset_id} was not found in the downloaded archives')
+    return [filenames.get(dataset_id) for dataset_id in dataset_ids]
+
+# download the given search items, returns the paths of the archives in the same order (None for failed downloads)
+def download_search_items(config, args, items):
+    if getattr(args, 'batch_size', 0) > 0:
+        return download_search_items_by_batch(config, args, items)
+
+    workers = getattr(args, 'workers', 1)
+    if workers <= 1:
+        return [download_search_result_item(config, args, item) for item in items]
+
+    # one aggregate progress bar for the whole page instead of one bar per dataset
+    bar = tqdm(total=len(items), unit='dataset') if tqdm else None
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(download_search_result_item, config, args, item, False) for item in items]
+        for future in as_completed(futures):
+            if bar: bar.update(1)
+    if bar: bar.close()
+    return [future.result() for future in futures]
+
+# download the items of the given search response, or of every page of the search if no response is given
+def download_search_results(config, args, response=None):
+
+    if response is None:
+        for items in iter_search_pages(config, args, prefetch=True):
+            download_search_items(config, args, items)
+    elif response.status_code == 200:
+        download_search_items(config, args, response.json()['content'])
     return
 
 
@@ -429,6 +804,5 @@ if __name__ == '__main__':
     add_arguments(parser)
     args = parser.parse_args()
     config = initialize(args)
-    response = solr_search(config, args)
-    download_search_results(config, args, response)
+    download_search_results(config, args)
 